@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Startup benchmark for cultivate
+
+Times the paths of the command line tool that should never touch the
+puppet repository (help output and argument errors) and checks that
+they do not import anything heavy. Exits non zero if the median time
+goes over budget or a forbidden module is imported.
+"""
+import os
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+
+CULTIVATE = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'cultivate'
+)
+
+# Invocations that must not scan a repository
+CASES = [
+    ['-h'],
+    ['migrate', '-h'],
+    ['--puppetdir', '/nonexistent', 'migrate'],
+]
+
+# Modules that must not be imported on the paths above
+FORBIDDEN = [
+    'tkinter',
+    'repolibs.puppetrepo',
+    'repolibs.gitrepo',
+]
+
+
+def imported_modules(args):
+    """
+    Returns the names of the modules imported when running cultivate
+    with the given arguments, using python -X importtime
+    """
+    run = subprocess.run(
+        [sys.executable, '-X', 'importtime', CULTIVATE] + args,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE
+    )
+    modules = []
+    for line in run.stderr.decode('utf-8').split('\n'):
+        if line.startswith('import time:') and '|' in line:
+            modules.append(line.rsplit('|', 1)[1].strip())
+    return modules
+
+
+def time_run(args, runs):
+    """
+    Returns the median wall clock time of running cultivate
+    with the given arguments
+    """
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, CULTIVATE] + args,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
+        )
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def main():
+    """
+    Run the benchmark
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--runs',
+        type=int,
+        default=10,
+        help='Runs per case. Default: 10'
+    )
+    parser.add_argument(
+        '--budget',
+        type=float,
+        default=0.3,
+        help='Maximum median time per case in seconds. Default: 0.3'
+    )
+    args = parser.parse_args()
+
+    failed = False
+    for case in CASES:
+        median = time_run(case, args.runs)
+        forbidden = [
+            module for module in imported_modules(case)
+            if module.split('.')[0] in FORBIDDEN or module in FORBIDDEN
+        ]
+
+        status = 'ok'
+        if median > args.budget or forbidden:
+            status = 'FAIL'
+            failed = True
+
+        print(
+            '%-45s %8.1f ms  %s'
+            % (' '.join(case), median * 1000, status)
+        )
+        for module in forbidden:
+            print('    imported %s' % module)
+
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
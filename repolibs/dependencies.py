@@ -0,0 +1,242 @@
+"""
+Module dependencies, read from the metadata.json of puppet modules
+"""
+import os
+import json
+from .moduleselector import ModuleSelector
+
+class DependencyError(Exception):
+    """
+    Raised when a module's metadata.json can't be read
+    """
+    def __init__(self, message):
+        """
+        Print out the error message
+        """
+        super().__init__()
+        self.message = message
+
+    def __str__(self):
+        """
+        String Representation of this object
+        """
+        return self.message
+
+def normalize_module_name(name):
+    """
+    Returns the directory name of a module from a dependency name.
+    puppetlabs/stdlib, puppetlabs-stdlib and stdlib are all stdlib.
+    """
+    name = name.strip().lower().replace('/', '-')
+    return name.split('-')[-1]
+
+# Dependencies keyed by metadata.json path, with the stat values
+# they were read for
+_metadata_cache = dict()
+
+def read_dependencies(module_root):
+    """
+    Returns the sorted names of the modules a module depends on,
+    from its metadata.json. A module without one has none.
+    Results are cached until the file changes.
+    """
+    path = module_root + '/metadata.json'
+    try:
+        status = os.stat(path)
+    except FileNotFoundError:
+        return []
+    except OSError as error:
+        raise DependencyError('Unable to read %s\n%s' % (path, error))
+
+    key = (status.st_size, status.st_mtime_ns, status.st_ino)
+    cached = _metadata_cache.get(path)
+    if cached and cached[0] == key:
+        return cached[1]
+
+    try:
+        with open(path, 'rb') as metadata_file:
+            metadata = json.loads(metadata_file.read().decode('utf-8'))
+    except (OSError, ValueError) as error:
+        raise DependencyError('Unable to read %s\n%s' % (path, error))
+
+    if not isinstance(metadata, dict)\
+    or not isinstance(metadata.get('dependencies', []), list):
+        raise DependencyError('%s is not module metadata' % path)
+
+    dependencies = set()
+    for dependency in metadata.get('dependencies', []):
+        if isinstance(dependency, dict)\
+        and isinstance(dependency.get('name'), str):
+            dependencies.add(normalize_module_name(dependency['name']))
+
+    dependencies = sorted(dependencies)
+    _metadata_cache[path] = (key, dependencies)
+    return dependencies
+
+class DependencyGraph(object):
+    """
+    Dependencies between the modules of an environment
+    """
+
+    def __init__(self, dependencies, errors=None):
+        """
+        dependencies is a dict of module name to the names of
+        the modules it depends on.
+        errors is a dict of module name to why its metadata
+        could not be read.
+        """
+        self.dependencies = dependencies
+        self.errors = errors or dict()
+
+    @classmethod
+    def scan(cls, modules_dir):
+        """
+        Build the graph for every module in modules_dir. Only the
+        metadata.json files are read, nothing is asked of git.
+        Modules with broken metadata are taken to have no dependencies,
+        and are listed in errors.
+        """
+        dependencies = dict()
+        errors = dict()
+        for name in sorted(os.listdir(modules_dir)):
+            module_root = modules_dir + '/' + name
+            if not os.path.isdir(module_root):
+                continue
+            try:
+                dependencies[name] = read_dependencies(module_root)
+            except DependencyError as error:
+                dependencies[name] = []
+                errors[name] = str(error)
+
+        return cls(dependencies, errors)
+
+    def closure(self, names):
+        """
+        Returns the given modules and everything they depend on,
+        directly or not, sorted. Dependencies that are not in the
+        graph are left out, see missing.
+        """
+        seen = set()
+        pending = [name for name in names if name in self.dependencies]
+        while pending:
+            name = pending.pop()
+            if name in seen:
+                continue
+            seen.add(name)
+            pending += [
+                dependency for dependency in self.dependencies[name]
+                if dependency in self.dependencies
+            ]
+
+        return sorted(seen)
+
+    def missing(self, names):
+        """
+        Returns the dependencies of the given modules' closure
+        that are not in the graph, as a dict of module name to
+        the modules that need it
+        """
+        missing = dict()
+        for name in self.closure(names):
+            for dependency in self.dependencies[name]:
+                if dependency not in self.dependencies:
+                    missing.setdefault(dependency, []).append(name)
+        return missing
+
+    def reverse(self):
+        """
+        Returns a dict of module name to the sorted names of the
+        modules that depend on it directly
+        """
+        reverse = dict((name, []) for name in self.dependencies)
+        for name in sorted(self.dependencies):
+            for dependency in self.dependencies[name]:
+                reverse.setdefault(dependency, []).append(name)
+        return reverse
+
+    def dependents(self, name, reverse=None):
+        """
+        Returns the modules that depend on name, directly or not, sorted.
+        reverse is the result of reverse, if already worked out.
+        """
+        if reverse is None:
+            reverse = self.reverse()
+        seen = set()
+        pending = list(reverse.get(name, []))
+        while pending:
+            dependent = pending.pop()
+            if dependent in seen:
+                continue
+            seen.add(dependent)
+            pending += reverse.get(dependent, [])
+
+        seen.discard(name)
+        return sorted(seen)
+
+    def report(self, module_selector=None):
+        """
+        Returns a text view of who depends on each module.
+        With a module_selector only the selected modules are listed,
+        their dependents are listed whether selected or not.
+        """
+        reverse = self.reverse()
+        names = sorted(reverse)
+        if module_selector:
+            names = module_selector.filter(names)
+
+        representation = ''
+        for name in names:
+            representation += '    Module Name: %s%s\n' % (
+                name,
+                '' if name in self.dependencies else ' (not installed)'
+            )
+            representation += '        Required by : %s\n'\
+                % (', '.join(reverse[name]) or '-')
+            indirect = [
+                dependent for dependent in self.dependents(name, reverse)
+                if dependent not in reverse[name]
+            ]
+            if indirect:
+                representation += '        Indirectly  : %s\n'\
+                    % ', '.join(indirect)
+            if name in self.errors:
+                representation += '        Error       : %s\n'\
+                    % self.errors[name].replace('\n', ' ')
+
+        return representation
+
+def expand_selector(modules_dir, module_selector):
+    """
+    Returns a ModuleSelector for the modules module_selector selects
+    in modules_dir, plus everything they depend on, and the
+    DependencyGraph it was worked out from.
+    The original selectors are kept, so modules that only exist in the
+    target environment are still selected.
+    """
+    graph = DependencyGraph.scan(modules_dir)
+    selected = module_selector.filter(sorted(graph.dependencies))
+    added = [
+        name for name in graph.closure(selected)
+        if not module_selector.matches(name)
+    ]
+    return (ModuleSelector(module_selector.selectors + added), graph)
+
+def reverse_dependency_report(repo_root, module_selector=None):
+    """
+    Returns the reverse dependency view of every environment in
+    a puppet configuration repository
+    """
+    env_base_dir = repo_root + '/environments'
+    representation = ''
+    for env in sorted(os.listdir(env_base_dir)):
+        modules_dir = '%s/%s/modules' % (env_base_dir, env)
+        if not os.path.isdir(modules_dir):
+            continue
+        representation += 'Env Name: ' + env + "\n"
+        representation += "Reverse dependencies:\n"
+        representation += DependencyGraph.scan(modules_dir).report(
+            module_selector
+        )
+        representation += "\n"
+
+    return representation
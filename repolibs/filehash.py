@@ -0,0 +1,296 @@
+"""
+File hashing and comparison of module directory trees
+"""
+import os
+import mmap
+import stat
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+
+# Size of the chunks large files are hashed in, must be a multiple
+# of the mmap allocation granularity
+CHUNK_SIZE = 8 * 1024 * 1024
+
+# Files at least this large are hashed chunk by chunk in parallel
+LARGE_FILE_SIZE = 64 * 1024 * 1024
+
+# Block size used when reading small files
+READ_SIZE = 1024 * 1024
+
+def hash_chunk(path, offset, length):
+    """
+    Returns the sha256 digest of length bytes of path starting at
+    offset. The chunk is memory mapped and hashed in place, without
+    copying it into a python bytes object.
+    NOTE: runs in the worker processes of FileHasher
+    """
+    with open(path, 'rb') as chunk_file:
+        with mmap.mmap(
+            chunk_file.fileno(),
+            length,
+            access=mmap.ACCESS_READ,
+            offset=offset
+        ) as chunk:
+            return hashlib.sha256(chunk).digest()
+
+class FileDigest(object):
+    """
+    Digest of a single file.
+    Large files also keep the digest of every chunk, so two digests
+    can tell which byte ranges differ.
+    """
+
+    def __init__(self, size, digest, chunk_size=None, chunk_digests=None):
+        """
+        Create a digest of a file of size bytes
+        """
+        self.size = size
+        self.digest = digest
+        self.chunk_size = chunk_size
+        self.chunk_digests = chunk_digests
+
+    def changed_ranges(self, other):
+        """
+        Returns the (offset, length) byte ranges of this file that
+        differ from the file other was taken from, or None if that
+        can't be worked out from the chunk digests.
+        """
+        if self.digest == other.digest:
+            return []
+
+        if self.chunk_digests is None\
+        or other.chunk_digests is None\
+        or self.size != other.size\
+        or self.chunk_size != other.chunk_size:
+            return None
+
+        ranges = []
+        for index, (mine, theirs) in enumerate(
+                zip(self.chunk_digests, other.chunk_digests)
+        ):
+            if mine == theirs:
+                continue
+            offset = index * self.chunk_size
+            length = min(self.chunk_size, self.size - offset)
+
+            # Merge with the previous range if they touch
+            if ranges and ranges[-1][0] + ranges[-1][1] == offset:
+                ranges[-1] = (ranges[-1][0], ranges[-1][1] + length)
+            else:
+                ranges.append((offset, length))
+
+        return ranges
+
+    def __eq__(self, other):
+        """
+        Digests are equal if the files had the same content
+        """
+        return isinstance(other, FileDigest)\
+            and self.size == other.size\
+            and self.digest == other.digest
+
+    def __ne__(self, other):
+        """
+        Inverse of __eq__
+        """
+        return not self == other
+
+class FileHasher(object):
+    """
+    Hashes files, small files in a single pass in this process and
+    large files in chunks across a process pool.
+    Digests are cached by path, size, modification time and inode, so
+    files that have not changed are not hashed again.
+    """
+
+    def __init__(
+            self,
+            chunk_size=CHUNK_SIZE,
+            large_file_size=LARGE_FILE_SIZE,
+            processes=None
+    ):
+        """
+        Set up a hasher. processes defaults to the number of CPUs.
+        """
+        if chunk_size % mmap.ALLOCATIONGRANULARITY:
+            raise ValueError(
+                'chunk_size must be a multiple of %d'
+                % mmap.ALLOCATIONGRANULARITY
+            )
+
+        self.chunk_size = chunk_size
+        self.large_file_size = large_file_size
+        self.processes = processes
+        self.pool = None
+        self.cache = dict()
+
+    def hash_files(self, paths):
+        """
+        Returns a dict of path to FileDigest for the given paths
+        """
+        digests = dict()
+        large_files = dict()
+
+        for path in paths:
+            status = os.stat(path)
+            key = (status.st_size, status.st_mtime_ns, status.st_ino)
+
+            cached = self.cache.get(path)
+            if cached and cached[0] == key:
+                digests[path] = cached[1]
+            elif status.st_size >= self.large_file_size:
+                large_files[path] = key
+            else:
+                digests[path] = self.hash_small_file(path, status.st_size)
+                self.cache[path] = (key, digests[path])
+
+        if large_files:
+            for path, digest in self.hash_large_files(large_files).items():
+                digests[path] = digest
+                self.cache[path] = (large_files[path], digest)
+
+        return digests
+
+    @classmethod
+    def hash_small_file(cls, path, size):
+        """
+        Hash a file in a single pass
+        """
+        digest = hashlib.sha256()
+        with open(path, 'rb') as small_file:
+            block = small_file.read(READ_SIZE)
+            while block:
+                digest.update(block)
+                block = small_file.read(READ_SIZE)
+
+        return FileDigest(size, digest.digest())
+
+    def hash_large_files(self, large_files):
+        """
+        Hash every chunk of the given files across the process pool.
+        The digest of a whole file is the digest of its chunk digests.
+        """
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(self.processes)
+
+        futures = dict()
+        sizes = dict()
+        for path, key in large_files.items():
+            sizes[path] = key[0]
+            futures[path] = [
+                self.pool.submit(
+                    hash_chunk,
+                    path,
+                    offset,
+                    min(self.chunk_size, key[0] - offset)
+                )
+                for offset in range(0, key[0], self.chunk_size)
+            ]
+
+        digests = dict()
+        for path, chunk_futures in futures.items():
+            chunk_digests = [future.result() for future in chunk_futures]
+            digests[path] = FileDigest(
+                sizes[path],
+                hashlib.sha256(b''.join(chunk_digests)).digest(),
+                self.chunk_size,
+                chunk_digests
+            )
+
+        return digests
+
+    def close(self):
+        """
+        Shut down the process pool, if one was started
+        """
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+def scan_tree(root):
+    """
+    Returns the directories (with their permission bits), files (with
+    their sizes and permission bits) and symlinks (with their targets)
+    below root, keyed by path relative to root
+    """
+    dirs = dict()
+    files = dict()
+    links = dict()
+
+    for dirpath, dirnames, filenames in os.walk(root):
+        reldir = os.path.relpath(dirpath, root)
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            relpath = os.path.normpath(os.path.join(reldir, name))
+            status = os.lstat(path)
+            if stat.S_ISLNK(status.st_mode):
+                links[relpath] = os.readlink(path)
+            elif stat.S_ISDIR(status.st_mode):
+                dirs[relpath] = stat.S_IMODE(status.st_mode)
+            else:
+                files[relpath] =\
+                    (status.st_size, stat.S_IMODE(status.st_mode))
+
+    return dirs, files, links
+
+def compare_trees(left_root, right_root, hasher):
+    """
+    Compare the contents of two directory trees.
+    Returns a dict of the relative paths that differ. The value is
+    the list of (offset, length) ranges of the left file that differ
+    from the right file, or None if the whole path differs. Paths
+    whose permissions differ are included, as rsync copies those.
+    An empty dict means the trees are the same.
+    """
+    left_dirs, left_files, left_links = scan_tree(left_root)
+    right_dirs, right_files, right_links = scan_tree(right_root)
+
+    changed = dict()
+    for path in set(left_dirs) | set(right_dirs):
+        if left_dirs.get(path) != right_dirs.get(path):
+            changed[path] = None
+    for path in set(left_links) | set(right_links):
+        if left_links.get(path) != right_links.get(path):
+            changed[path] = None
+    for path in set(left_files) ^ set(right_files):
+        changed[path] = None
+
+    # Only files of the same size and mode need their contents checked
+    same_size = [
+        path for path in left_files
+        if path in right_files and left_files[path] == right_files[path]
+    ]
+    for path in left_files:
+        if path in right_files and path not in same_size:
+            changed[path] = None
+
+    digests = hasher.hash_files(
+        [os.path.join(left_root, path) for path in same_size] +
+        [os.path.join(right_root, path) for path in same_size]
+    )
+    for path in same_size:
+        left_digest = digests[os.path.join(left_root, path)]
+        right_digest = digests[os.path.join(right_root, path)]
+        if left_digest != right_digest:
+            changed[path] = left_digest.changed_ranges(right_digest)
+
+    return changed
+
+def rewrite_ranges(source, target, ranges):
+    """
+    Copy the given (offset, length) byte ranges of source into target
+    in place, leaving the rest of target alone.
+    NOTE: source and target must be the same size
+    """
+    with open(source, 'rb') as source_file:
+        with open(target, 'r+b') as target_file:
+            for offset, length in ranges:
+                source_file.seek(offset)
+                target_file.seek(offset)
+                remaining = length
+                while remaining:
+                    block = source_file.read(min(READ_SIZE, remaining))
+                    if not block:
+                        break
+                    target_file.write(block)
+                    remaining -= len(block)
@@ -27,6 +27,10 @@ class GitRepo(object):
     """
     Representation of a git repository
     """
+
+    # git -c options used when touching the index, see fast_status_options
+    _fast_status_options = None
+
     def __init__(self, starting_dir):
         """
         Gather information on the current git repo
@@ -36,7 +40,17 @@ class GitRepo(object):
             raise GitRepoError('Path ' + starting_dir + ' is not a directory')
 
         self.root_dir = self.find_repo_root(starting_dir)
-        self.submodules = self.find_submodules()
+        self._submodules = None
+
+    @property
+    def submodules(self):
+        """
+        The submodules of this repository, only looked up when needed
+        as git submodule has to visit every submodule.
+        """
+        if self._submodules is None:
+            self._submodules = self.find_submodules()
+        return self._submodules
 
     @classmethod
     def find_repo_root(cls, starting_dir):
@@ -47,27 +61,57 @@ class GitRepo(object):
         """
         # Change into the base directory
         os.chdir(starting_dir)
-        # Run the git status command
-        git_status = Popen(['git', 'status'], stdout=PIPE, stderr=PIPE)
-        (stdout, stderr) = git_status.communicate()
-
-        # Parse each line of the file, and add the module_path
-        # to the corresponding environment
-        fatal_error = re.compile(r'^fatal: Not a git repository')
-        for line in stderr.decode('utf-8').split('\n'):
-            matches = fatal_error.search(line)
-            if matches:
-                raise GitRepoError('Not inside a git repository.')
-
-        # Find a .gitmodules file in the current file path
-        git_root_dir = './'
-        while not os.path.isdir(git_root_dir + '.git'):
-            git_root_dir = "../" + git_root_dir
-
-        # Change into the root directory to allow the rest of the
-        # program to have a sane starting point, and return the
-        # full path of the root dir
-        return os.path.abspath(git_root_dir)
+        # Ask git for the top level, this does not scan the working tree
+        # the way git status does
+        toplevel = Popen(
+            ['git', 'rev-parse', '--show-toplevel'],
+            stdout=PIPE,
+            stderr=PIPE
+        )
+        (stdout, stderr) = toplevel.communicate()
+
+        if toplevel.returncode != 0:
+            raise GitRepoError('Not inside a git repository.')
+
+        # Return the full path of the root dir
+        return os.path.abspath(stdout.decode('utf-8').strip())
+
+    @classmethod
+    def find_ancestors(cls, queries, batch_size=32):
+        """
+        Answer a batch of ancestry questions.
+        queries is a list of (repo_dir, ancestor, descendant) tuples,
+        returns a list of booleans, True where ancestor is an
+        ancestor of descendant in repo_dir. Commits that repo_dir does
+        not know about are treated as not being ancestors.
+        The checks are run concurrently, batch_size at a time, and use
+        the commit-graph where the repository has one.
+        """
+        answers = []
+        for start in range(0, len(queries), batch_size):
+            running = [
+                Popen(
+                    [
+                        'git',
+                        '-c',
+                        'core.commitGraph=true',
+                        'merge-base',
+                        '--is-ancestor',
+                        ancestor,
+                        descendant
+                    ],
+                    stdout=PIPE,
+                    stderr=PIPE,
+                    cwd=repo_dir
+                )
+                for (repo_dir, ancestor, descendant)
+                in queries[start:start + batch_size]
+            ]
+            for merge_base in running:
+                merge_base.communicate()
+                answers.append(merge_base.returncode == 0)
+
+        return answers
 
     @classmethod
     def find_submodules(cls):
@@ -106,70 +150,89 @@ class GitRepo(object):
     def current_branch(self):
         """
         Get the current branch
+        Reads the branch straight from HEAD rather than parsing
+        the output of git status, so no working tree scan is done.
         """
-        branchre = re.compile(r'^On branch (?P<branchname>.*)$')
-        branchname = ''
+        branch = Popen(
+            ['git', 'symbolic-ref', '--short', '-q', 'HEAD'],
+            stdout=PIPE,
+            stderr=PIPE,
+            cwd=self.root_dir
+        )
+        stdout = branch.communicate()[0]
 
-        try:
-            # Get the current branch
-            status = Popen(['git', 'status'], stdout=PIPE)
+        if branch.returncode != 0:
+            raise GitRepoError(
+                'Could not determine the current branch\n'
+            )
 
-            # Parse each line of the file, and add the module_path
-            # to the corresponding environment
-            stdout = status.communicate()[0]
-            for line in stdout.decode('utf-8').split('\n'):
-                matches = branchre.search(line)
-                if matches:
-                    branchname = matches.group('branchname')
+        return stdout.decode('utf-8').strip()
 
-            if status.returncode != 0:
-                raise GitRepoError(
-                    'Could not determine the current branch\n'
-                )
+    @classmethod
+    def fast_status_options(cls):
+        """
+        Returns the git -c options that speed up index refreshes.
+        The untracked cache is always requested, the builtin fsmonitor
+        daemon only if this git was built with it.
+        """
+        if cls._fast_status_options is None:
+            options = ['-c', 'core.untrackedCache=true']
 
-            return branchname
+            version = Popen(
+                ['git', 'version', '--build-options'],
+                stdout=PIPE,
+                stderr=PIPE
+            )
+            stdout = version.communicate()[0]
+            if version.returncode == 0\
+            and 'feature: fsmonitor--daemon' in stdout.decode('utf-8'):
+                options += ['-c', 'core.fsmonitor=true']
 
-        except CalledProcessError:
-            if status.returncode != 0:
-                raise GitRepoError(
-                    'Could not determine the current branch\n'
-                )
+            cls._fast_status_options = options
+
+        return cls._fast_status_options
 
-    def commit(self, commit_message):
+    def commit(self, commit_message, all_files=False):
         """
-        Commit the current changes with current changes
+        Commit the changes currently staged in the index.
+        If all_files is set, every tracked file that has changed is
+        committed as well (git commit -a), which requires a full scan
+        of the working tree.
         """
-        nothingtocommitre = re.compile(
-            r'.*nothing to commit, working directory clean.*'
-        )
-        try:
-            # Commit the current changes.
-            commit = Popen(
-                [
-                    'git',
-                    'commit',
-                    '-m',
-                    '%s' % commit_message,
-                    '-a',
-                ],
-                stdout=PIPE
+        # Ask git whether there is anything to commit, rather than
+        # reading its (translated) output
+        if all_files:
+            check = ['git', 'diff', '--quiet', 'HEAD']
+        else:
+            check = ['git', 'diff', '--cached', '--quiet']
+        diff = Popen(check, stdout=PIPE, stderr=STDOUT, cwd=self.root_dir)
+        stdout = diff.communicate()[0]
+        if diff.returncode == 0:
+            return
+        if diff.returncode != 1:
+            raise GitRepoError(
+                'Could not check for changes\n%s'
+                % stdout.decode('utf-8')
             )
-            stdout = commit.communicate()[0]
 
-            if commit.returncode != 0:
-                match = nothingtocommitre.search(stdout.decode('utf-8'))
-                if not match:
-                    raise GitRepoError(
-                        'Could not commit changes\n%s'
-                        % stdout
-                    )
+        command = ['git', 'commit', '-m', '%s' % commit_message]
+        if all_files:
+            command.append('-a')
 
-        except CalledProcessError:
-            if commit.returncode != 0:
-                raise GitRepoError(
-                    'Could not commit changes\n%s'
-                    % stdout
-                )
+        # Commit the current changes.
+        commit = Popen(
+            command,
+            stdout=PIPE,
+            stderr=STDOUT,
+            cwd=self.root_dir
+        )
+        stdout = commit.communicate()[0]
+
+        if commit.returncode != 0:
+            raise GitRepoError(
+                'Could not commit changes\n%s'
+                % stdout.decode('utf-8')
+            )
 
     def add_all(self):
         """
@@ -199,6 +262,104 @@ class GitRepo(object):
                     % stdout
                 )
 
+    def add_paths(self, paths):
+        """
+        Stage exactly the given paths, including deletions, in a
+        single git call instead of rescanning the whole repository.
+        Paths may be absolute or relative to the repository root,
+        paths outside of the repository are skipped.
+        Returns the list of paths handed to git, relative to the root.
+        """
+        # Compare resolved paths, the puppetdir may be reached through
+        # a symlink while git reports the resolved root
+        root_dir = os.path.realpath(self.root_dir)
+        pathspecs = []
+        for path in paths:
+            # Only the parent is resolved, a path that is a symlink
+            # itself is staged as the link
+            path = os.path.normpath(os.path.join(self.root_dir, path))
+            relpath = os.path.relpath(
+                os.path.join(
+                    os.path.realpath(os.path.dirname(path)),
+                    os.path.basename(path)
+                ),
+                root_dir
+            )
+            if relpath == os.pardir\
+            or relpath.startswith(os.pardir + os.sep):
+                continue
+            if relpath not in pathspecs:
+                pathspecs.append(relpath)
+
+        # git refuses pathspecs that match nothing, e.g. an untracked
+        # module that a migration removed
+        missing = [
+            relpath for relpath in pathspecs
+            if not os.path.lexists(os.path.join(self.root_dir, relpath))
+        ]
+        if missing:
+            tracked = self.tracked_paths(missing)
+            pathspecs = [
+                relpath for relpath in pathspecs
+                if relpath not in missing or relpath in tracked
+            ]
+
+        if not pathspecs:
+            return pathspecs
+
+        # Hand all the paths to git on stdin, NUL separated
+        git_add = Popen(
+            ['git', '--literal-pathspecs'] + self.fast_status_options() + [
+                'add',
+                '--all',
+                '--pathspec-from-file=-',
+                '--pathspec-file-nul',
+            ],
+            stdin=PIPE,
+            stdout=PIPE,
+            stderr=STDOUT,
+            cwd=self.root_dir
+        )
+        stdout = git_add.communicate(
+            '\0'.join(pathspecs).encode('utf-8')
+        )[0]
+        if git_add.returncode != 0:
+            raise GitRepoError(
+                'Could not add changes\n%s'
+                % stdout.decode('utf-8')
+            )
+
+        return pathspecs
+
+    def tracked_paths(self, relpaths):
+        """
+        Returns the given paths, relative to the root, that are
+        in the index themselves or have files in it below them
+        """
+        ls_files = Popen(
+            ['git', '--literal-pathspecs', 'ls-files', '-z', '--'] + relpaths,
+            stdout=PIPE,
+            stderr=STDOUT,
+            cwd=self.root_dir
+        )
+        stdout = ls_files.communicate()[0]
+        if ls_files.returncode != 0:
+            raise GitRepoError(
+                'Could not list tracked files\n%s'
+                % stdout.decode('utf-8')
+            )
+
+        files = [
+            name for name in stdout.decode('utf-8').split('\0') if name
+        ]
+        return [
+            relpath for relpath in relpaths
+            if any(
+                name == relpath or name.startswith(relpath + '/')
+                for name in files
+            )
+        ]
+
     def push(self, remote='origin', force=False):
         """
         Push the changes to the repository.
@@ -224,7 +385,8 @@ class GitRepo(object):
             commit = Popen(
                 command,
                 stdout=PIPE,
-                stderr=PIPE
+                stderr=PIPE,
+                cwd=self.root_dir
             )
             (stdout, stderr) = commit.communicate()
             if commit.returncode != 0:
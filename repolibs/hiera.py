@@ -0,0 +1,386 @@
+"""
+Batch hiera lookups against the hiera data of puppet environments
+"""
+import os
+import re
+import json
+import fnmatch
+import hashlib
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+class HieraError(Exception):
+    """
+    Raised on issues with hiera configuration or data
+    """
+    def __init__(self, message):
+        """
+        Print out the error message
+        """
+        super().__init__()
+        self.message = message
+
+    def __str__(self):
+        """
+        String Representation of this object
+        """
+        return self.message
+
+# Extensions of the data files that are indexed
+DATA_EXTENSIONS = ['.yaml', '.yml', '.json']
+
+# Merge behaviours understood by lookup
+MERGE_STRATEGIES = ['first', 'unique', 'hash', 'deep']
+
+def load_data(path, content):
+    """
+    Parse the content of a hiera data or configuration file
+    """
+    if path.endswith('.json'):
+        return json.loads(content.decode('utf-8'))
+
+    if yaml is None:
+        raise HieraError(
+            'PyYAML is needed to read %s' % path
+        )
+    try:
+        return yaml.safe_load(content)
+    except yaml.YAMLError as error:
+        raise ValueError(str(error))
+
+class HieraHierarchy(object):
+    """
+    The hierarchy from a hiera.yaml, version 3 or 5.
+    Every level is a list of paths, relative to an environment's hiera
+    directory, that may contain %{} interpolations.
+    """
+
+    def __init__(self, config_path):
+        """
+        Read the hierarchy from config_path
+        """
+        try:
+            with open(config_path, 'rb') as config_file:
+                config = load_data(config_path, config_file.read())
+        except (OSError, ValueError) as error:
+            raise HieraError(
+                'Unable to read %s\n%s' % (config_path, error)
+            )
+
+        if not isinstance(config, dict):
+            raise HieraError('%s is not a hiera configuration' % config_path)
+
+        # Hiera 3 uses symbols as keys, which YAML reads as :name
+        config = dict(
+            (str(key).lstrip(':'), value) for key, value in config.items()
+        )
+
+        self.levels = []
+        if config.get('version') == 5:
+            for level in config.get('hierarchy', []):
+                paths = []
+                for key in ['path', 'paths', 'glob', 'globs']:
+                    value = level.get(key)
+                    if isinstance(value, str):
+                        paths.append((value, key.startswith('glob')))
+                    elif value:
+                        paths += [
+                            (path, key.startswith('glob')) for path in value
+                        ]
+                self.levels.append(paths)
+        else:
+            # Hiera 3 levels have no extension, one is added when
+            # looking for the data file
+            for level in config.get('hierarchy', ['common']):
+                self.levels.append([(level, False)])
+
+        self.extension_free = config.get('version') != 5
+
+    def paths(self, scope, index):
+        """
+        Returns the data file paths, relative to the environment's
+        hiera directory, for the given scope, in priority order.
+        Only paths that exist in index are returned.
+        """
+        paths = []
+        for level in self.levels:
+            for (pattern, is_glob) in level:
+                path = interpolate(pattern, scope)
+                if is_glob:
+                    candidates = sorted(
+                        candidate for candidate in index
+                        if fnmatch.fnmatchcase(candidate, path)
+                    )
+                elif self.extension_free:
+                    candidates = [
+                        path + extension for extension in DATA_EXTENSIONS
+                    ]
+                else:
+                    candidates = [path]
+
+                for candidate in candidates:
+                    candidate = os.path.normpath(candidate)
+                    if candidate in index and candidate not in paths:
+                        paths.append(candidate)
+
+        return paths
+
+# %{name}, %{::name} and %{facts.a.b} interpolations
+INTERPOLATION = re.compile(r'%\{(?P<name>[^}(]*)\}')
+
+def scope_value(scope, name):
+    """
+    Look up a dotted variable name in a scope
+    """
+    name = name.strip()
+    if name.startswith('::'):
+        name = name[2:]
+
+    value = scope
+    for part in name.split('.'):
+        if isinstance(value, dict) and part in value:
+            value = value[part]
+        else:
+            return None
+    return value
+
+def interpolate(value, scope):
+    """
+    Replace the %{} variables in a value, recursing into lists and
+    hashes. Unknown variables become empty strings, like in hiera.
+    Function calls such as %{lookup('key')} are left as they are.
+    """
+    if isinstance(value, str):
+        def replace(match):
+            found = scope_value(scope, match.group('name'))
+            return '' if found is None else str(found)
+        return INTERPOLATION.sub(replace, value)
+    if isinstance(value, list):
+        return [interpolate(item, scope) for item in value]
+    if isinstance(value, dict):
+        return dict(
+            (key, interpolate(item, scope)) for key, item in value.items()
+        )
+    return value
+
+def deep_merge(lower, higher):
+    """
+    Merge two hashes, values from higher win, nested hashes are merged
+    """
+    merged = dict(lower)
+    for key, value in higher.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = deep_merge(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+class HieraResolver(object):
+    """
+    Resolves hiera keys for many nodes at once.
+    Each environment's data files are indexed once. Parsed files are
+    cached by their digest, so files that are the same in several
+    environments are only parsed once.
+    """
+
+    def __init__(self, hiera_root, config_path=None):
+        """
+        Set up a resolver for the hiera data in
+        hiera_root/environments/<env>.
+        config_path defaults to hiera.yaml in hiera_root, or in its
+        parent directory.
+        """
+        self.hiera_root = hiera_root
+        if config_path is None:
+            for candidate in [
+                    hiera_root + '/hiera.yaml',
+                    os.path.dirname(os.path.abspath(hiera_root)) +
+                    '/hiera.yaml'
+            ]:
+                if os.path.isfile(candidate):
+                    config_path = candidate
+                    break
+            else:
+                raise HieraError(
+                    'No hiera.yaml found for %s' % hiera_root
+                )
+
+        self.hierarchy = HieraHierarchy(config_path)
+        # Parsed data keyed by file digest
+        self.data_cache = dict()
+        # Digests keyed by path, with the stat values they were for
+        self.digest_cache = dict()
+
+    def data_dir(self, env):
+        """
+        Directory holding the hiera data of an environment
+        """
+        data_dir = '%s/environments/%s' % (self.hiera_root, env)
+        if not os.path.isdir(data_dir):
+            raise HieraError('%s is not a directory' % data_dir)
+        return data_dir
+
+    def index(self, env):
+        """
+        Returns a dict of relative path to parsed data for every data
+        file of an environment
+        """
+        data_dir = self.data_dir(env)
+        index = dict()
+        for dirpath, dirnames, filenames in os.walk(data_dir):
+            for filename in filenames:
+                if os.path.splitext(filename)[1] not in DATA_EXTENSIONS:
+                    continue
+                path = os.path.join(dirpath, filename)
+                index[os.path.relpath(path, data_dir)] = self.load(path)
+
+        return index
+
+    def load(self, path):
+        """
+        Returns the parsed content of a data file, using the caches
+        """
+        status = os.stat(path)
+        key = (status.st_size, status.st_mtime_ns, status.st_ino)
+        cached = self.digest_cache.get(path)
+        if cached and cached[0] == key:
+            return self.data_cache[cached[1]]
+
+        with open(path, 'rb') as data_file:
+            content = data_file.read()
+        digest = hashlib.sha1(content).hexdigest()
+
+        if digest not in self.data_cache:
+            try:
+                data = load_data(path, content)
+            except ValueError as error:
+                raise HieraError('Unable to parse %s\n%s' % (path, error))
+            if data is None:
+                data = dict()
+            if not isinstance(data, dict):
+                raise HieraError('%s does not contain a hash' % path)
+            self.data_cache[digest] = data
+
+        self.digest_cache[path] = (key, digest)
+        return self.data_cache[digest]
+
+    @classmethod
+    def scope(cls, env, node, facts):
+        """
+        Returns the variables available to interpolation for a node.
+        facts may be None for a node listed without any.
+        """
+        if facts is None:
+            facts = dict()
+        if not isinstance(facts, dict):
+            raise HieraError('Facts of %s are not a hash' % node)
+
+        scope = dict(facts)
+        scope.setdefault('environment', env)
+        scope.setdefault('clientcert', node)
+        scope.setdefault('facts', dict(facts))
+        scope.setdefault('trusted', {'certname': node})
+        return scope
+
+    def lookup(self, env, keys, nodes, merge='first'):
+        """
+        Resolve keys for many nodes in one go.
+        nodes is a dict of node name to facts. keys defaults to every
+        key in the environment's data.
+        Returns a dict of node name to a dict of key to value, keys
+        not found for a node are left out.
+        """
+        if merge not in MERGE_STRATEGIES:
+            raise HieraError('Unknown merge strategy %s' % merge)
+
+        index = self.index(env)
+        if keys is None:
+            keys = self.all_keys(index)
+
+        # Nodes that end up with the same data files share the result
+        resolved = dict()
+        results = dict()
+        for node, facts in nodes.items():
+            scope = self.scope(env, node, facts)
+            paths = tuple(self.hierarchy.paths(scope, index))
+            if paths not in resolved:
+                resolved[paths] = self.resolve(index, paths, keys, merge)
+            results[node] = interpolate(resolved[paths], scope)
+
+        return results
+
+    @classmethod
+    def resolve(cls, index, paths, keys, merge):
+        """
+        Look up keys in the data files, in priority order
+        """
+        values = dict()
+        for key in keys:
+            found = [index[path][key] for path in paths if key in index[path]]
+            if not found:
+                continue
+
+            if merge == 'first':
+                values[key] = found[0]
+            elif merge == 'unique':
+                merged = []
+                for value in found:
+                    for item in value if isinstance(value, list) else [value]:
+                        if item not in merged:
+                            merged.append(item)
+                values[key] = merged
+            else:
+                merged = dict()
+                for value in reversed(found):
+                    if not isinstance(value, dict):
+                        raise HieraError(
+                            'Can not merge %s, it is not a hash' % key
+                        )
+                    if merge == 'deep':
+                        merged = deep_merge(merged, value)
+                    else:
+                        merged.update(value)
+                values[key] = merged
+
+        return values
+
+    @classmethod
+    def all_keys(cls, index):
+        """
+        Returns every key found in an index, sorted
+        """
+        keys = set()
+        for data in index.values():
+            keys.update(data.keys())
+        return sorted(keys)
+
+    def diff(self, from_env, to_env, keys, nodes, merge='first'):
+        """
+        Compare the effective values of keys between two environments.
+        keys defaults to every key in either environment's data.
+        Returns a dict of node name to a dict of key to
+        (from value, to value), for the keys that differ only.
+        Missing values are None.
+        """
+        if keys is None:
+            keys = sorted(
+                set(self.all_keys(self.index(from_env))) |
+                set(self.all_keys(self.index(to_env)))
+            )
+
+        from_values = self.lookup(from_env, keys, nodes, merge)
+        to_values = self.lookup(to_env, keys, nodes, merge)
+
+        differences = dict()
+        for node in nodes:
+            for key in keys:
+                from_value = from_values[node].get(key)
+                to_value = to_values[node].get(key)
+                if from_value != to_value:
+                    differences.setdefault(node, dict())[key] =\
+                        (from_value, to_value)
+
+        return differences
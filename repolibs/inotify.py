@@ -0,0 +1,180 @@
+"""
+Minimal inotify bindings, using ctypes so no extra packages are needed
+"""
+import os
+import errno
+import ctypes
+import ctypes.util
+import struct
+
+# Event masks, from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+
+# Everything that changes the contents of a directory tree
+IN_CHANGES = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |\
+    IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+# Flags for inotify_init1
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+# struct inotify_event without the trailing name
+EVENT_HEADER = struct.Struct('iIII')
+
+class InotifyError(Exception):
+    """
+    Raised when inotify can't be used
+    """
+    def __init__(self, message):
+        """
+        Print out the error message
+        """
+        super().__init__()
+        self.message = message
+
+    def __str__(self):
+        """
+        String Representation of this object
+        """
+        return self.message
+
+class Inotify(object):
+    """
+    An inotify instance with a set of watched paths
+    """
+
+    # Class handle on libc, loaded on first use
+    libc = None
+
+    def __init__(self):
+        """
+        Create a non blocking inotify instance
+        """
+        if Inotify.libc is None:
+            libc_name = ctypes.util.find_library('c')
+            if not libc_name:
+                raise InotifyError('Unable to find libc')
+            Inotify.libc = ctypes.CDLL(libc_name, use_errno=True)
+            if not hasattr(Inotify.libc, 'inotify_init1'):
+                raise InotifyError('inotify is not available')
+
+        self.fd = Inotify.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise InotifyError(
+                'inotify_init1 failed: %s' % os.strerror(ctypes.get_errno())
+            )
+
+        # Map of watch descriptor to path, and back
+        self.paths = dict()
+        self.watches = dict()
+
+    def fileno(self):
+        """
+        File descriptor to select on
+        """
+        return self.fd
+
+    def add_watch(self, path, mask=IN_CHANGES):
+        """
+        Watch a path, returns the watch descriptor.
+        Paths that have disappeared in the mean time are skipped
+        and None returned.
+        """
+        wd = Inotify.libc.inotify_add_watch(
+            self.fd,
+            os.fsencode(path),
+            mask | IN_DONT_FOLLOW
+        )
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error in (errno.ENOENT, errno.ENOTDIR):
+                return None
+            raise InotifyError(
+                'Unable to watch %s: %s' % (path, os.strerror(error))
+            )
+
+        self.paths[wd] = path
+        self.watches[path] = wd
+        return wd
+
+    def add_tree(self, root, mask=IN_CHANGES):
+        """
+        Watch a directory and every directory below it
+        """
+        self.add_watch(root, mask | IN_ONLYDIR)
+        for dirpath, dirnames, filenames in os.walk(root):
+            for dirname in dirnames:
+                self.add_watch(os.path.join(dirpath, dirname), mask)
+
+    def remove_tree(self, root):
+        """
+        Stop watching a directory and every watched path below it
+        """
+        prefix = root.rstrip('/') + '/'
+        for path in list(self.watches):
+            if path == root or path.startswith(prefix):
+                # The kernel may already have dropped the watch
+                Inotify.libc.inotify_rm_watch(self.fd, self.watches[path])
+                del self.paths[self.watches[path]]
+                del self.watches[path]
+
+    def read_events(self):
+        """
+        Returns the pending events as a list of (path, mask) tuples,
+        where path is the full path the event happened to.
+        If the kernel queue overflowed, a single (None, IN_Q_OVERFLOW)
+        event is included.
+        """
+        events = []
+        while True:
+            try:
+                buffer = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+
+            offset = 0
+            while offset < len(buffer):
+                (wd, mask, cookie, length) =\
+                    EVENT_HEADER.unpack_from(buffer, offset)
+                offset += EVENT_HEADER.size
+                name = buffer[offset:offset + length].rstrip(b'\0')
+                offset += length
+
+                if mask & IN_Q_OVERFLOW:
+                    events.append((None, mask))
+                    continue
+
+                path = self.paths.get(wd)
+                if path is None:
+                    continue
+                if mask & IN_IGNORED:
+                    # The watched path has gone away
+                    del self.paths[wd]
+                    self.watches.pop(path, None)
+                    continue
+                if name:
+                    path = os.path.join(path, os.fsdecode(name))
+                events.append((path, mask))
+
+        return events
+
+    def close(self):
+        """
+        Close the inotify instance
+        """
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
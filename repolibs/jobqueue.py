@@ -0,0 +1,442 @@
+"""
+Queue of migrations, shared by all cultivate processes on a host through
+files and locks in a queue directory
+"""
+import os
+import json
+import time
+import fcntl
+from .gitrepo import GitRepoError
+from .moduleselector import ModuleSelector
+from .puppetrepo import PuppetConfigRepo, PuppetConfigRepoError
+
+class MigrationQueueError(PuppetConfigRepoError):
+    """
+    Raised when a queued migration fails
+    """
+
+def default_queue_dir(puppetdir):
+    """
+    Returns the queue directory used for a puppet directory when none
+    is given. It lives inside the .git directory when there is one, so
+    it never shows up as untracked files.
+    """
+    if os.path.isdir(puppetdir + '/.git'):
+        return os.path.abspath(puppetdir + '/.git/cultivate-queue')
+    return os.path.abspath(puppetdir + '/.cultivate-queue')
+
+class MigrationJob(object):
+    """
+    A single queued migration
+    """
+
+    def __init__(
+            self,
+            from_env,
+            to_env,
+            modules=None,
+            hiera_paths=None,
+            job_id=None,
+            status='queued',
+            error=None
+    ):
+        """
+        Create a job. modules and hiera_paths are selector strings,
+        as given to ModuleSelector.
+        """
+        self.from_env = from_env
+        self.to_env = to_env
+        self.modules = modules
+        self.hiera_paths = hiera_paths
+        # Job ids sort in submission order
+        self.job_id = job_id or '%020d-%d' % (time.time_ns(), os.getpid())
+        self.status = status
+        self.error = error
+
+    @classmethod
+    def from_dict(cls, values):
+        """
+        Create a job from its saved form
+        """
+        return cls(**values)
+
+    def to_dict(self):
+        """
+        Returns the saved form of this job
+        """
+        return {
+            'from_env': self.from_env,
+            'to_env': self.to_env,
+            'modules': self.modules,
+            'hiera_paths': self.hiera_paths,
+            'job_id': self.job_id,
+            'status': self.status,
+            'error': self.error
+        }
+
+    def hiera_selectors(self):
+        """
+        Returns the hiera selectors this job migrates, None if it
+        migrates all the hiera data, or an empty list for none.
+        """
+        if self.hiera_paths:
+            return ModuleSelector(self.hiera_paths).selectors
+        if not self.modules:
+            return None
+        return []
+
+    def __str__(self):
+        """
+        String representation of a MigrationJob
+        """
+        return '%s: %s -> %s (%s)' % (
+            self.job_id,
+            self.from_env,
+            self.to_env,
+            self.status
+        )
+
+class MigrationQueue(object):
+    """
+    Runs migrations one target environment at a time.
+    Each migration holds an exclusive lock on its target environment
+    and a shared lock on its source, so migrations into different
+    environments run in parallel. Whoever holds the target lock runs
+    every queued job for that target, merging jobs from the same source
+    into one sync, and commits and pushes them together.
+    """
+
+    # How long to wait before trying again when the target lock was
+    # taken but our job could not run yet
+    retry_interval = 0.1
+
+    def __init__(self, queue_dir, repo_root, hiera_root):
+        """
+        Set up a queue in queue_dir for the given puppet repository
+        """
+        self.queue_dir = queue_dir
+        self.jobs_dir = queue_dir + '/jobs'
+        self.locks_dir = queue_dir + '/locks'
+        self.repo_root = repo_root
+        self.hiera_root = hiera_root
+        # Locks held on the jobs this process submitted, keyed by job id.
+        # A queued job whose lock can be taken was left behind by a
+        # process that died.
+        self.job_locks = dict()
+
+        for directory in [self.jobs_dir, self.locks_dir]:
+            os.makedirs(directory, exist_ok=True)
+
+    def run(
+            self,
+            from_env,
+            to_env,
+            modules=None,
+            hiera_paths=None,
+            progress=None
+    ):
+        """
+        Queue a migration and wait for it, running it if nobody else
+        does. Raises MigrationQueueError if the migration failed.
+        progress is an optional MigrationProgress, fed by any batch
+        this process runs.
+        """
+        job = self.wait(
+            self.submit(from_env, to_env, modules, hiera_paths),
+            progress
+        )
+        if job.status == 'failed':
+            raise MigrationQueueError(
+                'Migration between %s and %s failed\n%s'
+                % (from_env, to_env, job.error)
+            )
+        return job
+
+    def submit(self, from_env, to_env, modules=None, hiera_paths=None):
+        """
+        Add a migration to the queue. The job stays locked until it
+        is collected by wait.
+        """
+        if from_env == to_env:
+            raise MigrationQueueError(
+                'Can not migrate %s into itself' % from_env
+            )
+
+        job = MigrationJob(from_env, to_env, modules, hiera_paths)
+        # Lock before saving, so nobody ever sees the job unlocked
+        self.job_locks[job.job_id] = self.lock('job-' + job.job_id)
+        self.save_job(job)
+        return job
+
+    def wait(self, job, progress=None):
+        """
+        Wait until a job has finished, running queued jobs for its
+        target environment whenever its lock can be taken.
+        Returns the finished job, and removes it from the queue.
+        """
+        while True:
+            job = self.load_job(job.job_id)
+            if job.status in ['done', 'failed']:
+                self.remove_job(job.job_id)
+                return job
+
+            batch = []
+            locks = self.lock_environments(job.from_env, job.to_env)
+            try:
+                job = self.load_job(job.job_id)
+                if job.status in ['done', 'failed']:
+                    continue
+                batch = self.claim_batch(job.to_env, locks)
+                if batch:
+                    self.run_batch(batch, progress)
+            finally:
+                for lock in locks.values():
+                    lock.close()
+
+            if job.job_id not in [queued.job_id for queued in batch]:
+                time.sleep(MigrationQueue.retry_interval)
+
+    def lock(self, name, shared=False, blocking=True):
+        """
+        Take a lock, returns the open lock file or None if it is
+        not blocking and the lock is held elsewhere.
+        The lock is released when the file is closed.
+        """
+        lock_file = open('%s/%s.lock' % (self.locks_dir, name), 'a')
+        operation = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        if not blocking:
+            operation |= fcntl.LOCK_NB
+
+        try:
+            fcntl.flock(lock_file, operation)
+        except BlockingIOError:
+            lock_file.close()
+            return None
+
+        return lock_file
+
+    def lock_environments(self, from_env, to_env):
+        """
+        Lock the source environment shared and the target exclusive.
+        Locks are always taken in name order, so two migrations in
+        opposite directions can't deadlock.
+        Returns a dict of environment to lock file.
+        """
+        locks = dict()
+        for env in sorted(set([from_env, to_env])):
+            locks[env] = self.lock(
+                'env-' + env,
+                shared=(env != to_env)
+            )
+        return locks
+
+    def claim_batch(self, to_env, locks):
+        """
+        Returns the queued jobs for to_env that can run now, in order.
+        Stops at the first job that reads from to_env, as it has to see
+        the target as the earlier jobs leave it. Jobs from other sources
+        are only included if their source can be locked without waiting,
+        and their locks are added to locks.
+        NOTE: the caller must hold the lock on to_env, so any job for it
+        still marked running was left behind by a process that died.
+        """
+        batch = []
+        for job in self.queued_jobs():
+            if self.is_orphaned(job):
+                # Nobody is waiting for it any more
+                self.remove_job(job.job_id)
+                continue
+            if job.from_env == to_env:
+                break
+            if job.to_env != to_env:
+                continue
+
+            if job.from_env not in locks:
+                lock = self.lock(
+                    'env-' + job.from_env,
+                    shared=True,
+                    blocking=False
+                )
+                if lock is None:
+                    break
+                locks[job.from_env] = lock
+
+            batch.append(job)
+
+        return batch
+
+    def run_batch(self, batch, progress=None):
+        """
+        Run a batch of jobs for the same target. Adjacent jobs from the
+        same source are synced together, and everything synced is
+        committed and pushed once.
+        """
+        for job in batch:
+            job.status = 'running'
+            self.save_job(job)
+
+        # Group adjacent jobs with the same source
+        groups = []
+        for job in batch:
+            if groups and groups[-1][0].from_env == job.from_env:
+                groups[-1].append(job)
+            else:
+                groups.append([job])
+
+        touched_paths = []
+        synced = []
+        puppetrepo = None
+        for group in groups:
+            (module_selector, hiera_selector) = self.merge_selectors(group)
+            try:
+                puppetrepo = PuppetConfigRepo(
+                    self.repo_root,
+                    self.hiera_root,
+                    module_selector
+                )
+                touched_paths += puppetrepo.sync(
+                    group[0].from_env,
+                    group[0].to_env,
+                    hiera_selector,
+                    progress
+                )
+                synced += group
+            except (PuppetConfigRepoError, GitRepoError, OSError) as error:
+                self.finish(group, 'failed', str(error))
+
+        if not synced:
+            return
+
+        # The index is shared by all environments, so only one
+        # commit and push at a time
+        git_lock = self.lock('git')
+        try:
+            puppetrepo.commit_changes(
+                touched_paths,
+                'Migrated changes from %s to %s.\n\nJobs: %s'
+                % (
+                    ', '.join(
+                        sorted(set(job.from_env for job in synced))
+                    ),
+                    synced[0].to_env,
+                    ', '.join(job.job_id for job in synced)
+                ),
+                progress
+            )
+            self.finish(synced, 'done')
+        except (PuppetConfigRepoError, GitRepoError, OSError) as error:
+            self.finish(synced, 'failed', str(error))
+        finally:
+            git_lock.close()
+
+    @classmethod
+    def merge_selectors(cls, jobs):
+        """
+        Returns the module selector and hiera selector that migrate
+        everything the given jobs would between them
+        """
+        module_selector = None
+        if all(job.modules for job in jobs):
+            selectors = []
+            for job in jobs:
+                for selector in ModuleSelector(job.modules).selectors:
+                    if selector not in selectors:
+                        selectors.append(selector)
+            module_selector = ModuleSelector(selectors)
+
+        hiera_selectors = [job.hiera_selectors() for job in jobs]
+        hiera_selector = None
+        if None in hiera_selectors:
+            # Some job migrates all the hiera data
+            if module_selector:
+                hiera_selector = ModuleSelector('*')
+        else:
+            selectors = []
+            for job_selectors in hiera_selectors:
+                for selector in job_selectors:
+                    if selector not in selectors:
+                        selectors.append(selector)
+            if selectors:
+                hiera_selector = ModuleSelector(selectors)
+
+        return (module_selector, hiera_selector)
+
+    def finish(self, jobs, status, error=None):
+        """
+        Record the outcome of some jobs
+        """
+        for job in jobs:
+            job.status = status
+            job.error = error
+            self.save_job(job)
+
+    def is_orphaned(self, job):
+        """
+        Returns True if the process that submitted a job has died
+        """
+        if job.job_id in self.job_locks:
+            return False
+
+        lock = self.lock('job-' + job.job_id, blocking=False)
+        if lock is None:
+            return False
+        lock.close()
+        return True
+
+    def remove_job(self, job_id):
+        """
+        Remove a job and its lock from the queue
+        """
+        for path in [
+                self.job_path(job_id),
+                '%s/job-%s.lock' % (self.locks_dir, job_id)
+        ]:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+        lock = self.job_locks.pop(job_id, None)
+        if lock is not None:
+            lock.close()
+
+    def job_path(self, job_id):
+        """
+        Path of the file a job is saved in
+        """
+        return '%s/%s.json' % (self.jobs_dir, job_id)
+
+    def save_job(self, job):
+        """
+        Save a job, replacing the file in one step so readers never
+        see half a job
+        """
+        temp_path = self.job_path(job.job_id) + '.tmp'
+        with open(temp_path, 'w') as job_file:
+            json.dump(job.to_dict(), job_file)
+        os.replace(temp_path, self.job_path(job.job_id))
+
+    def load_job(self, job_id):
+        """
+        Load a saved job
+        """
+        with open(self.job_path(job_id)) as job_file:
+            return MigrationJob.from_dict(json.load(job_file))
+
+    def queued_jobs(self):
+        """
+        Returns the jobs that have not finished, in submission order
+        """
+        jobs = []
+        for filename in sorted(os.listdir(self.jobs_dir)):
+            if not filename.endswith('.json'):
+                continue
+            try:
+                job = self.load_job(filename[:-len('.json')])
+            except (OSError, ValueError):
+                # Finished and removed while we were looking
+                continue
+            if job.status in ['queued', 'running']:
+                jobs.append(job)
+
+        return jobs
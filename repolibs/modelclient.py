@@ -0,0 +1,98 @@
+"""
+Client for the cultivate model server
+NOTE: kept free of the heavier repolibs imports, so querying a running
+server stays fast
+"""
+import os
+import json
+import socket
+
+class ModelServerError(Exception):
+    """
+    Raised when the model server returns an error
+    """
+    def __init__(self, message):
+        """
+        Print out the error message
+        """
+        super().__init__()
+        self.message = message
+
+    def __str__(self):
+        """
+        String Representation of this object
+        """
+        return self.message
+
+def default_socket_path(puppetdir):
+    """
+    Returns the socket path used for a puppet directory when none is
+    given. It lives inside the .git directory when there is one, so it
+    never shows up as an untracked file.
+    """
+    if os.path.isdir(puppetdir + '/.git'):
+        return os.path.abspath(puppetdir + '/.git/cultivate.sock')
+    return os.path.abspath(puppetdir + '/.cultivate.sock')
+
+class ModelClient(object):
+    """
+    Sends requests to a model server over its Unix socket.
+    Requests and responses are single lines of JSON.
+    """
+
+    def __init__(self, socket_path, timeout=60):
+        """
+        Set up a client for the server listening on socket_path
+        """
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+    def is_available(self):
+        """
+        Returns True if there is a socket to connect to
+        """
+        return os.path.exists(self.socket_path)
+
+    def query(self, command, modules=None, **arguments):
+        """
+        Run a command on the server and return its output.
+        modules is the module selector, as a string, the output must be
+        for. None means every module.
+        Returns None if no server is listening or the server holds a
+        different selection of modules, raises ModelServerError if the
+        server could not answer.
+        """
+        request = dict(arguments)
+        request['command'] = command
+
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.settimeout(self.timeout)
+        try:
+            try:
+                connection.connect(self.socket_path)
+            except (FileNotFoundError, ConnectionRefusedError):
+                return None
+
+            connection.sendall(json.dumps(request).encode('utf-8') + b'\n')
+
+            response = b''
+            while not response.endswith(b'\n'):
+                data = connection.recv(65536)
+                if not data:
+                    break
+                response += data
+        finally:
+            connection.close()
+
+        try:
+            response = json.loads(response.decode('utf-8'))
+        except ValueError:
+            raise ModelServerError('Invalid response from model server')
+
+        if not response.get('ok'):
+            raise ModelServerError(response.get('error', 'Unknown error'))
+
+        if response.get('modules') != modules:
+            return None
+
+        return response['output']
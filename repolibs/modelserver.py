@@ -0,0 +1,426 @@
+"""
+Model server, keeps a PuppetConfigRepo in memory and up to date with
+the files on disk using inotify, and answers queries over a Unix socket
+"""
+import os
+import json
+import time
+import socket
+import select
+from .inotify import\
+    Inotify,\
+    InotifyError,\
+    IN_CHANGES,\
+    IN_CREATE,\
+    IN_MOVED_TO,\
+    IN_ISDIR,\
+    IN_Q_OVERFLOW
+from .puppetrepo import\
+    PuppetConfigRepoError,\
+    PuppetEnvComparison
+
+class ModelServer(object):
+    """
+    Serves a PuppetConfigRepo model.
+    Changes on disk only invalidate the affected modules and
+    comparisons, the rest of the model is kept.
+    """
+
+    def __init__(self, puppetrepo, socket_path, settle_time=0.1):
+        """
+        Set up a server for puppetrepo listening on socket_path.
+        settle_time is how long to wait for more events after a change,
+        so that e.g. an rsync is applied as a single update.
+        """
+        self.puppetrepo = puppetrepo
+        self.socket_path = socket_path
+        self.settle_time = settle_time
+        self.env_base_dir = os.path.abspath(
+            self.puppetrepo.repo_root + '/environments'
+        )
+        self.hiera_root = os.path.abspath(self.puppetrepo.hiera_root)
+        self.git_dir = None
+        if self.puppetrepo.gitrepo:
+            self.git_dir = self.puppetrepo.gitrepo.root_dir + '/.git'
+
+        # Cached PuppetEnvComparisons, keyed by (from_env, to_env)
+        self.comparisons = dict()
+        # Map of submodule git directory to (env, module)
+        self.submodule_git_dirs = dict()
+        # Counters of the updates applied, reported by status
+        self.generations = {'model': 0, 'hiera': 0}
+        # Changes whose rescan failed, tried again with the next
+        # event or request
+        self.failed_changes = set()
+        # Error of the last failed rescan, reported by status
+        self.last_error = None
+        self.running = False
+        self.inotify = None
+        self.server = None
+
+    def serve_forever(self):
+        """
+        Watch the repository and answer requests until shutdown
+        """
+        self.inotify = Inotify()
+        self.watch_all()
+        self.listen()
+        self.running = True
+
+        try:
+            while self.running:
+                readable = select.select(
+                    [self.inotify, self.server],
+                    [],
+                    []
+                )[0]
+                if self.inotify in readable:
+                    self.process_events(settle=True)
+                if self.server in readable:
+                    self.handle_connection()
+        finally:
+            self.close()
+
+    def shutdown(self):
+        """
+        Stop serve_forever after the current request
+        """
+        self.running = False
+
+    def close(self):
+        """
+        Close the socket and the inotify instance
+        """
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+
+    def listen(self):
+        """
+        Create the Unix socket, replacing a stale one left behind
+        """
+        if os.path.exists(self.socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.socket_path)
+                probe.close()
+                raise PuppetConfigRepoError(
+                    'A server is already listening on %s'
+                    % self.socket_path
+                )
+            except ConnectionRefusedError:
+                os.unlink(self.socket_path)
+
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o077)
+        try:
+            self.server.bind(self.socket_path)
+        finally:
+            os.umask(old_umask)
+        self.server.listen(16)
+
+    def watch_all(self):
+        """
+        Set up the watches for the whole repository
+        """
+        self.submodule_git_dirs = dict()
+        self.inotify.add_watch(self.env_base_dir)
+        for env in self.puppetrepo.environments.values():
+            self.watch_environment(env)
+
+        self.inotify.add_tree(self.hiera_root)
+
+        # Only HEAD is of interest in the top level git directory
+        if self.git_dir and os.path.isdir(self.git_dir):
+            self.inotify.add_watch(self.git_dir)
+
+    def watch_environment(self, env):
+        """
+        Watch an environment and all of its modules
+        """
+        self.inotify.add_watch(env.root_dir)
+        self.inotify.add_watch(env.root_dir + '/modules')
+        for module in env.modules.values():
+            self.watch_module(env, module)
+
+    def watch_module(self, env, module):
+        """
+        Watch the files of a module, and the git directory of
+        a submodule so that new checkouts are seen
+        """
+        self.inotify.add_tree(module.module_root)
+        if module.is_submodule:
+            git_dir = self.find_git_dir(module.module_root)
+            if git_dir:
+                self.submodule_git_dirs[git_dir] =\
+                    (env.envname, module.module_name)
+                self.inotify.add_watch(git_dir)
+
+    @classmethod
+    def find_git_dir(cls, module_root):
+        """
+        Returns the git directory a submodule's .git file points to
+        """
+        try:
+            with open(module_root + '/.git') as git_file:
+                line = git_file.readline().strip()
+        except OSError:
+            return None
+
+        if not line.startswith('gitdir:'):
+            return None
+        return os.path.abspath(
+            os.path.join(module_root, line[len('gitdir:'):].strip())
+        )
+
+    def classify(self, path):
+        """
+        Work out what part of the model a changed path belongs to.
+        Returns one of
+        ('reload',), ('hiera',), ('environment', env),
+        ('module', env, module) or None if it does not matter.
+        """
+        if path.startswith(self.env_base_dir + '/'):
+            parts = path[len(self.env_base_dir) + 1:].split('/')
+            if len(parts) == 1\
+            or (len(parts) == 2 and parts[1] == 'modules'):
+                return ('environment', parts[0])
+            if parts[1] == 'modules':
+                return ('module', parts[0], parts[2])
+            return None
+
+        if path == self.hiera_root\
+        or path.startswith(self.hiera_root + '/'):
+            return ('hiera',)
+
+        parent = os.path.dirname(path)
+        if parent in self.submodule_git_dirs\
+        and os.path.basename(path) == 'HEAD':
+            return ('module',) + self.submodule_git_dirs[parent]
+
+        if self.git_dir and parent == self.git_dir\
+        and os.path.basename(path) == 'HEAD':
+            return ('reload',)
+
+        return None
+
+    def process_events(self, settle=False):
+        """
+        Read the pending inotify events and update the model.
+        With settle, keep collecting events until none have arrived
+        for settle_time.
+        """
+        events = self.inotify.read_events()
+        while settle and events:
+            time.sleep(self.settle_time)
+            more = self.inotify.read_events()
+            if not more:
+                break
+            events += more
+
+        if not events and not self.failed_changes:
+            return
+
+        changes = set()
+        for path, mask in events:
+            if mask & IN_Q_OVERFLOW:
+                changes.add(('reload',))
+                continue
+
+            # New directories need watching themselves
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO)\
+            and path.startswith(self.hiera_root + '/'):
+                self.inotify.add_tree(path, IN_CHANGES)
+
+            change = self.classify(path)
+            if change:
+                changes.add(change)
+
+        if changes or self.failed_changes:
+            self.apply_changes(changes)
+
+    def apply_changes(self, changes):
+        """
+        Update the model for a set of changes from classify.
+        Files can vanish while they are rescanned, e.g. in the middle
+        of an rsync. A change that fails drops the comparisons it
+        affects and is tried again later, the server keeps running.
+        """
+        changes = set(changes) | self.failed_changes
+        self.failed_changes = set()
+
+        if ('reload',) in changes:
+            self.try_change(('reload',), self.reload)
+            return
+
+        if ('hiera',) in changes:
+            self.generations['hiera'] += 1
+
+        refreshed_envs = set()
+        for change in changes:
+            if change[0] == 'environment':
+                self.try_change(change, self.refresh_environment, change[1])
+                refreshed_envs.add(change[1])
+
+        for change in changes:
+            if change[0] == 'module' and change[1] not in refreshed_envs:
+                self.try_change(
+                    change,
+                    self.refresh_module,
+                    change[1],
+                    change[2]
+                )
+
+        self.generations['model'] += 1
+
+    def try_change(self, change, method, *arguments):
+        """
+        Apply a single change. If it fails, forget the comparisons of
+        its environment, so they are rebuilt when next asked for, and
+        keep the change to try again.
+        """
+        try:
+            method(*arguments)
+        except (PuppetConfigRepoError, InotifyError, OSError) as error:
+            self.last_error = '%s: %s' % (' '.join(change), error)
+            self.failed_changes.add(change)
+            if change == ('reload',):
+                self.comparisons = dict()
+                return
+            for key in list(self.comparisons):
+                if change[1] in key:
+                    del self.comparisons[key]
+
+    def reload(self):
+        """
+        Throw away the model and build it again
+        """
+        self.puppetrepo.environments = self.puppetrepo.find_environments()
+        self.comparisons = dict()
+        self.inotify.close()
+        self.inotify = Inotify()
+        self.watch_all()
+        self.generations['model'] += 1
+        self.generations['hiera'] += 1
+
+    def refresh_environment(self, envname):
+        """
+        Rescan a whole environment, dropping its comparisons
+        """
+        self.inotify.remove_tree(self.env_base_dir + '/' + envname)
+        env = self.puppetrepo.refresh_environment(envname)
+        if env:
+            self.watch_environment(env)
+
+        for key in list(self.comparisons):
+            if envname in key:
+                del self.comparisons[key]
+
+    def refresh_module(self, envname, module_name):
+        """
+        Rescan a single module and redo only its comparisons
+        """
+        env = self.puppetrepo.environments.get(envname)
+        if env is None:
+            self.refresh_environment(envname)
+            return
+
+        module_root = env.root_dir + '/modules/' + module_name
+        self.inotify.remove_tree(module_root)
+        module = env.refresh_module(module_name)
+        if module:
+            self.watch_module(env, module)
+
+        for key, comparison in self.comparisons.items():
+            if envname in key:
+                comparison.refresh_module(module_name)
+
+    def modules(self):
+        """
+        Returns the module selector the model was scanned with,
+        as a string, or None if it holds every module
+        """
+        if self.puppetrepo.module_selector:
+            return str(self.puppetrepo.module_selector)
+        return None
+
+    def comparison(self, from_env, to_env):
+        """
+        Returns the cached comparison of two environments
+        """
+        for env in [from_env, to_env]:
+            if env not in self.puppetrepo.environments:
+                raise PuppetConfigRepoError(
+                    '{} environment does not exist'.format(env)
+                )
+
+        key = (from_env, to_env)
+        if key not in self.comparisons:
+            self.comparisons[key] = PuppetEnvComparison(
+                self.puppetrepo.environments[from_env],
+                self.puppetrepo.environments[to_env]
+            )
+        return self.comparisons[key]
+
+    def handle_connection(self):
+        """
+        Answer a single request
+        """
+        connection = self.server.accept()[0]
+        connection.settimeout(5)
+        try:
+            request = b''
+            while not request.endswith(b'\n'):
+                data = connection.recv(65536)
+                if not data:
+                    break
+                request += data
+
+            try:
+                response = {
+                    'ok': True,
+                    'output': self.handle(json.loads(request.decode('utf-8'))),
+                    'modules': self.modules()
+                }
+            except (ValueError, KeyError, PuppetConfigRepoError) as error:
+                response = {'ok': False, 'error': str(error)}
+
+            connection.sendall(json.dumps(response).encode('utf-8') + b'\n')
+        except OSError:
+            # The client went away
+            pass
+        finally:
+            connection.close()
+
+    def handle(self, request):
+        """
+        Run a request and return its output
+        """
+        # Bring the model up to date with anything not yet seen
+        self.process_events()
+
+        command = request['command']
+        if command == 'report':
+            return str(self.puppetrepo)
+        elif command == 'compare':
+            return str(self.comparison(request['from_env'], request['to_env']))
+        elif command == 'status':
+            return 'Environments: %s\nModel updates: %d\nHiera updates: %d\n'\
+                'Pending rescans: %d\nLast rescan error: %s\n'\
+                % (
+                    ', '.join(sorted(self.puppetrepo.env_names())),
+                    self.generations['model'],
+                    self.generations['hiera'],
+                    len(self.failed_changes),
+                    self.last_error
+                )
+        elif command == 'shutdown':
+            self.shutdown()
+            return 'Shutting down\n'
+
+        raise ValueError('Unknown command %s' % command)
@@ -0,0 +1,114 @@
+"""
+Selection of modules and hiera paths by name
+"""
+import re
+import fnmatch
+
+class ModuleSelectorError(Exception):
+    """
+    Raised when a selector pattern is invalid
+    """
+    def __init__(self, message):
+        """
+        Print out the error message
+        """
+        super().__init__()
+        self.message = message
+
+    def __str__(self):
+        """
+        String Representation of this object
+        """
+        return self.message
+
+class ModuleSelector(object):
+    """
+    Matches names against a list of selectors.
+    Selectors are glob patterns (profile_*, nginx), or regular
+    expressions when prefixed with re: (re:^profile_(web|db)$).
+    """
+
+    # Prefix marking a selector as a regular expression
+    regex_prefix = 're:'
+
+    def __init__(self, selectors):
+        """
+        Build the selector from a comma separated string
+        or a list of selectors
+        """
+        if isinstance(selectors, str):
+            selectors = ModuleSelector.split(selectors)
+
+        self.selectors = [
+            selector.strip() for selector in selectors
+            if selector.strip()
+        ]
+        if not self.selectors:
+            raise ModuleSelectorError('No selectors given')
+
+        # Each selector is compiled on its own, so that inline flags
+        # such as (?i) apply to just that selector
+        self.matchers = []
+        for selector in self.selectors:
+            if selector.startswith(ModuleSelector.regex_prefix):
+                pattern = selector[len(ModuleSelector.regex_prefix):]
+            else:
+                pattern = '^' + fnmatch.translate(selector)
+            try:
+                self.matchers.append(re.compile(pattern))
+            except re.error as error:
+                raise ModuleSelectorError(
+                    'Invalid regular expression %s: %s'
+                    % (pattern, error)
+                )
+
+    @classmethod
+    def split(cls, selectors):
+        """
+        Split a comma separated string of selectors. Commas inside
+        (), {} or [] belong to the selector, as in re:^a{1,2}$, and
+        so does a comma escaped with a backslash.
+        """
+        parts = []
+        current = ''
+        depth = 0
+        escaped = False
+        for char in selectors:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char in '({[':
+                depth += 1
+            elif char in ')}]' and depth:
+                depth -= 1
+            elif char == ',' and not depth:
+                parts.append(current)
+                current = ''
+                continue
+            current += char
+
+        parts.append(current)
+        return parts
+
+    def matches(self, name):
+        """
+        Returns True if the name is selected.
+        Globs must match the whole name, regular expressions
+        match anywhere unless anchored.
+        """
+        return any(
+            matcher.search(name) is not None for matcher in self.matchers
+        )
+
+    def filter(self, names):
+        """
+        Returns the selected names, keeping their order
+        """
+        return [name for name in names if self.matches(name)]
+
+    def __str__(self):
+        """
+        String representation of a ModuleSelector
+        """
+        return ','.join(self.selectors)
@@ -0,0 +1,216 @@
+"""
+Run cultivate operations over many puppet configuration repositories
+in a process pool
+"""
+import io
+import os
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
+from .moduleselector import ModuleSelector
+from .puppetrepo import\
+    PuppetConfigRepo,\
+    PuppetConfigRepoError,\
+    PuppetEnvComparison
+from .jobqueue import MigrationQueue, default_queue_dir
+from .dependencies import expand_selector, reverse_dependency_report
+
+class RepoSpec(object):
+    """
+    Location of a puppet configuration repository and its hiera data
+    """
+
+    def __init__(self, puppetdir, hieradir='hiera'):
+        """
+        hieradir is relative to puppetdir unless it starts with a /
+        """
+        self.puppetdir = os.path.abspath(puppetdir)
+        if hieradir[0] != '/':
+            hieradir = '%s/%s' % (self.puppetdir, hieradir)
+        self.hieradir = hieradir
+
+    def __str__(self):
+        """
+        String representation of a RepoSpec
+        """
+        return self.puppetdir
+
+def read_manifest(manifest_path, default_hieradir='hiera'):
+    """
+    Read a manifest of repositories, one per line as
+    puppetdir [hieradir]
+    Blank lines and lines starting with # are skipped. Relative
+    puppetdirs are relative to the manifest's directory.
+    """
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    specs = []
+    with open(manifest_path) as manifest:
+        for line in manifest:
+            fields = line.split()
+            if not fields or fields[0].startswith('#'):
+                continue
+            hieradir = fields[1] if len(fields) > 1 else default_hieradir
+            specs.append(
+                RepoSpec(os.path.join(base_dir, fields[0]), hieradir)
+            )
+
+    return specs
+
+class RepoResult(object):
+    """
+    Outcome of an operation on one repository
+    """
+
+    def __init__(self, spec, ok, output='', error=None):
+        """
+        Record the output, or the error if the operation failed
+        """
+        self.spec = spec
+        self.ok = ok
+        self.output = output
+        self.error = error
+
+def run_operation(spec, operation, arguments):
+    """
+    Run an operation on a single repository and return a RepoResult.
+    Anything the operation prints is captured into the output.
+    NOTE: runs in the worker processes of MultiRepoRunner
+    """
+    modules = arguments.get('modules')
+    module_selector = ModuleSelector(modules) if modules else None
+    hiera_paths = arguments.get('hiera_paths')
+    hiera_selector = ModuleSelector(hiera_paths) if hiera_paths else None
+
+    printed = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(printed):
+            output = perform_operation(
+                spec,
+                operation,
+                arguments,
+                module_selector,
+                hiera_selector
+            )
+    except Exception as error:
+        # Keep whatever was printed, e.g. why a migration is refused
+        return RepoResult(
+            spec,
+            False,
+            printed.getvalue(),
+            '%s: %s' % (type(error).__name__, error)
+        )
+
+    return RepoResult(spec, True, printed.getvalue() + output)
+
+def perform_operation(
+        spec,
+        operation,
+        arguments,
+        module_selector,
+        hiera_selector
+):
+    """
+    Do the work of run_operation, returns the output
+    """
+    if operation == 'report':
+        if arguments.get('reverse_deps'):
+            return reverse_dependency_report(spec.puppetdir, module_selector)
+        return str(
+            PuppetConfigRepo(
+                spec.puppetdir,
+                spec.hieradir,
+                module_selector
+            )
+        )
+
+    if operation == 'compare':
+        puppetrepo = PuppetConfigRepo(
+            spec.puppetdir,
+            spec.hieradir,
+            module_selector
+        )
+        for env in [arguments['from_env'], arguments['to_env']]:
+            if env not in puppetrepo.environments:
+                raise PuppetConfigRepoError(
+                    '{} environment does not exist'.format(env)
+                )
+        return str(PuppetEnvComparison(
+            puppetrepo.environments[arguments['from_env']],
+            puppetrepo.environments[arguments['to_env']]
+        ))
+
+    if operation == 'migrate':
+        if arguments.get('with_deps') and module_selector:
+            (module_selector, graph) = expand_selector(
+                '%s/environments/%s/modules'
+                % (spec.puppetdir, arguments['from_env']),
+                module_selector
+            )
+            print(
+                'Modules to migrate: %s'
+                % ', '.join(module_selector.filter(sorted(graph.dependencies)))
+            )
+        if arguments.get('no_queue'):
+            PuppetConfigRepo(
+                spec.puppetdir,
+                spec.hieradir,
+                module_selector
+            ).migrate(
+                arguments['from_env'],
+                arguments['to_env'],
+                hiera_selector
+            )
+        else:
+            MigrationQueue(
+                default_queue_dir(spec.puppetdir),
+                spec.puppetdir,
+                spec.hieradir
+            ).run(
+                arguments['from_env'],
+                arguments['to_env'],
+                module_selector and str(module_selector),
+                arguments.get('hiera_paths')
+            )
+        return 'Migration between %s and %s completed successfully'\
+            % (arguments['from_env'], arguments['to_env'])
+
+    raise PuppetConfigRepoError('Unknown operation %s' % operation)
+
+class MultiRepoRunner(object):
+    """
+    Runs the same operation on many repositories, one repository per
+    worker process at a time. A failure in one repository does not
+    stop the others.
+    """
+
+    def __init__(self, specs, processes=None):
+        """
+        Set up a runner for a list of RepoSpecs.
+        processes defaults to the number of CPUs.
+        """
+        self.specs = specs
+        self.processes = processes
+
+    def run(self, operation, **arguments):
+        """
+        Run operation on every repository.
+        Returns the RepoResults, in the same order as the specs.
+        """
+        with ProcessPoolExecutor(self.processes) as pool:
+            futures = [
+                pool.submit(run_operation, spec, operation, arguments)
+                for spec in self.specs
+            ]
+
+            results = []
+            for spec, future in zip(self.specs, futures):
+                try:
+                    results.append(future.result())
+                except Exception as error:
+                    # The worker itself died
+                    results.append(RepoResult(
+                        spec,
+                        False,
+                        error='%s: %s' % (type(error).__name__, error)
+                    ))
+
+        return results
@@ -0,0 +1,286 @@
+"""
+Progress reporting and throughput metrics for migrations
+"""
+import os
+import json
+import time
+import threading
+
+class MigrationProgress(object):
+    """
+    Keeps count of the work done by a migration, and reports it to a
+    terminal, as periodic JSON metrics lines and as a Prometheus
+    textfile. Every output is optional, with none given this only
+    counts.
+    A timer thread keeps the outputs updated while nothing is
+    transferred, so a stalled migration shows up as a growing
+    seconds_since_progress.
+    """
+
+    # Seconds of history used to work out the current throughput
+    rate_window = 10.0
+
+    # Minimum seconds between terminal redraws
+    redraw_interval = 0.2
+
+    # Minimum seconds between progress lines when not on a terminal
+    log_interval = 10.0
+
+    # Longest time between timer updates
+    tick_interval = 1.0
+
+    def __init__(
+            self,
+            stream=None,
+            metrics_stream=None,
+            metrics_interval=10.0,
+            textfile=None,
+            labels=None
+    ):
+        """
+        stream is a file to draw progress on, e.g. sys.stderr.
+        metrics_stream gets a JSON line every metrics_interval seconds.
+        textfile is a path the Prometheus metrics are written to.
+        labels are added to every Prometheus metric and JSON line.
+        """
+        self.stream = stream
+        self.metrics_stream = metrics_stream
+        self.metrics_interval = metrics_interval
+        self.textfile = textfile
+        self.labels = labels or dict()
+
+        self.phase = 'starting'
+        self.modules_total = 0
+        self.modules_done = 0
+        self.files = 0
+        self.bytes = 0
+        self.started = time.time()
+        self.last_progress = self.started
+        self.last_redraw = 0
+        self.last_metrics = 0
+        # (time, bytes) samples for the throughput
+        self.samples = [(self.started, 0)]
+
+        # update is called from the timer thread as well
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.timer = None
+        if self.stream or self.metrics_stream or self.textfile:
+            self.timer = threading.Thread(target=self.tick, daemon=True)
+            self.timer.start()
+
+    def tick(self):
+        """
+        Timer thread, updates the outputs until stop is called
+        """
+        interval = MigrationProgress.tick_interval
+        if self.metrics_stream or self.textfile:
+            interval = min(interval, self.metrics_interval)
+        interval = max(interval, MigrationProgress.redraw_interval)
+
+        while not self.stopped.wait(interval):
+            self.update()
+
+    def stop(self):
+        """
+        Stop the timer thread
+        """
+        self.stopped.set()
+        if self.timer is not None\
+        and self.timer is not threading.current_thread():
+            self.timer.join()
+        self.timer = None
+
+    def start_phase(self, phase, modules_total=None):
+        """
+        Start a phase of the migration: sync, hiera or git.
+        modules_total adds to the number of modules to migrate.
+        """
+        self.phase = phase
+        if modules_total:
+            self.modules_total += modules_total
+        self.update(force=True)
+
+    def module_done(self):
+        """
+        Count a module as migrated
+        """
+        self.modules_done += 1
+        self.last_progress = time.time()
+        self.update()
+
+    def file_transferred(self, size):
+        """
+        Count a file of size bytes as transferred
+        """
+        self.files += 1
+        self.bytes += size
+        self.last_progress = time.time()
+        self.update()
+
+    def bytes_transferred(self, size):
+        """
+        Count bytes written without a whole file being transferred
+        """
+        self.bytes += size
+        self.last_progress = time.time()
+        self.update()
+
+    def rate(self):
+        """
+        Current throughput in bytes per second
+        """
+        now = time.time()
+        self.samples.append((now, self.bytes))
+        while len(self.samples) > 2\
+        and self.samples[1][0] < now - MigrationProgress.rate_window:
+            self.samples.pop(0)
+
+        elapsed = now - self.samples[0][0]
+        if elapsed <= 0:
+            return 0.0
+        return (self.bytes - self.samples[0][1]) / elapsed
+
+    def eta(self):
+        """
+        Estimated seconds until all the modules are migrated,
+        or None if that can't be worked out yet
+        """
+        if not self.modules_done or not self.modules_total:
+            return None
+        elapsed = time.time() - self.started
+        remaining = self.modules_total - self.modules_done
+        return max(0.0, elapsed / self.modules_done * remaining)
+
+    def values(self):
+        """
+        Returns the current numbers as a dict
+        """
+        now = time.time()
+        return {
+            'phase': self.phase,
+            'modules_done': self.modules_done,
+            'modules_total': self.modules_total,
+            'files': self.files,
+            'bytes': self.bytes,
+            'bytes_per_second': round(self.rate(), 1),
+            'eta_seconds': self.eta(),
+            'elapsed_seconds': round(now - self.started, 3),
+            'seconds_since_progress': round(now - self.last_progress, 3)
+        }
+
+    def update(self, force=False):
+        """
+        Redraw the terminal line and emit metrics when due
+        """
+        with self.lock:
+            now = time.time()
+            if self.stream:
+                interval = MigrationProgress.log_interval
+                if self.stream.isatty():
+                    interval = MigrationProgress.redraw_interval
+                if force or now - self.last_redraw >= interval:
+                    self.last_redraw = now
+                    self.draw()
+
+            if (self.metrics_stream or self.textfile)\
+            and (force or now - self.last_metrics >= self.metrics_interval):
+                self.last_metrics = now
+                self.emit_metrics()
+
+    def draw(self):
+        """
+        Draw the progress line. On a terminal the line is redrawn in
+        place, otherwise a new line is written every time.
+        """
+        values = self.values()
+        eta = values['eta_seconds']
+        line = '[%s] modules %d/%d, %d files, %s, %s/s, ETA %s' % (
+            values['phase'],
+            values['modules_done'],
+            values['modules_total'],
+            values['files'],
+            human_size(values['bytes']),
+            human_size(values['bytes_per_second']),
+            '?' if eta is None else '%ds' % eta
+        )
+        if self.stream.isatty():
+            self.stream.write('\r\033[K' + line)
+        else:
+            self.stream.write(line + '\n')
+        self.stream.flush()
+
+    def emit_metrics(self):
+        """
+        Write a JSON metrics line and the Prometheus textfile
+        """
+        values = self.values()
+        values['time'] = round(time.time(), 3)
+        values.update(self.labels)
+
+        if self.metrics_stream:
+            self.metrics_stream.write(json.dumps(values) + '\n')
+            self.metrics_stream.flush()
+
+        if self.textfile:
+            self.write_textfile(values)
+
+    def write_textfile(self, values):
+        """
+        Write the metrics in Prometheus text format. The file is
+        replaced in one step, so a collector never reads half of it.
+        """
+        labels = ','.join(
+            '%s="%s"' % (name, value)
+            for name, value in sorted(self.labels.items())
+        )
+        metrics = [
+            ('modules_done', 'gauge', values['modules_done']),
+            ('modules_total', 'gauge', values['modules_total']),
+            ('files_transferred_total', 'counter', values['files']),
+            ('bytes_transferred_total', 'counter', values['bytes']),
+            ('bytes_per_second', 'gauge', values['bytes_per_second']),
+            ('eta_seconds', 'gauge', values['eta_seconds']),
+            ('last_progress_timestamp_seconds', 'gauge', self.last_progress),
+            ('last_update_timestamp_seconds', 'gauge', values['time']),
+        ]
+
+        lines = []
+        for name, metric_type, value in metrics:
+            if value is None:
+                continue
+            name = 'cultivate_migration_' + name
+            lines.append('# TYPE %s %s' % (name, metric_type))
+            lines.append('%s{%s} %s' % (name, labels, value))
+
+        phase_labels = ','.join(
+            filter(None, [labels, 'phase="%s"' % values['phase']])
+        )
+        lines.append('# TYPE cultivate_migration_phase gauge')
+        lines.append('cultivate_migration_phase{%s} 1' % phase_labels)
+
+        temp_path = self.textfile + '.tmp'
+        with open(temp_path, 'w') as textfile:
+            textfile.write('\n'.join(lines) + '\n')
+        os.replace(temp_path, self.textfile)
+
+    def finish(self):
+        """
+        Final update, ends the terminal line
+        """
+        self.stop()
+        self.phase = 'done'
+        self.update(force=True)
+        if self.stream and self.stream.isatty():
+            self.stream.write('\n')
+            self.stream.flush()
+
+def human_size(size):
+    """
+    Format a number of bytes for people
+    """
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if size < 1024:
+            return '%.1f%s' % (size, unit)
+        size /= 1024.0
+    return '%.1fTiB' % size
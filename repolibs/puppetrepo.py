@@ -4,8 +4,12 @@ Puppet Repository related objects
 import os
 import re
 import sys
+import shutil
 from subprocess import *
 from .gitrepo import GitRepo, GitRepoError
+from .filehash import FileHasher, compare_trees, rewrite_ranges
+from .dependencies import read_dependencies, DependencyError
+from .progress import MigrationProgress
 
 class PuppetConfigRepoError(Exception):
     """
@@ -61,6 +65,13 @@ class PuppetModule(object):
         else:
             self.commit = None
 
+        # Names of the modules this one depends on, from metadata.json
+        try:
+            self.dependencies = read_dependencies(module_root)
+        except DependencyError as error:
+            sys.stderr.write(str(error) + '\n')
+            self.dependencies = []
+
     def get_commit(self):
         """
         Returns the sha1sum of the commit our module is at
@@ -90,6 +101,47 @@ class PuppetModule(object):
             sys.stderr.write("Unable to get module commit shasum\n")
             sys.exit(1)
 
+    def fast_forward(self, source_module):
+        """
+        Move this submodule forward to the commit of source_module,
+        fetching the commit from it first.
+        """
+        if not self.is_submodule or not source_module.is_submodule:
+            raise PuppetModuleError(
+                'Can only fast forward submodules (%s)' % self.module_name
+            )
+
+        for command in [
+                [
+                    'git',
+                    'fetch',
+                    '--quiet',
+                    source_module.module_root,
+                    source_module.commit
+                ],
+                [
+                    'git',
+                    'checkout',
+                    '--quiet',
+                    '--detach',
+                    source_module.commit
+                ]
+        ]:
+            git = Popen(
+                command,
+                stdout=PIPE,
+                stderr=STDOUT,
+                cwd=self.module_root
+            )
+            stdout = git.communicate()[0]
+            if git.returncode != 0:
+                raise PuppetModuleError(
+                    'Could not fast forward module %s\n%s'
+                    % (self.module_name, stdout.decode('utf-8'))
+                )
+
+        self.commit = source_module.commit
+
     def __str__(self):
         """
         String representation of a PuppetModule
@@ -103,6 +155,11 @@ class PuppetModule(object):
             + "\n"
 
         representation += '        Commit      : ' + str(self.commit) + "\n"
+        if self.dependencies:
+            representation +=\
+                '        Depends on  : '\
+                + ', '.join(self.dependencies)\
+                + "\n"
         return representation
 
 
@@ -112,13 +169,15 @@ class PuppetConfigRepo(object):
     structure.
     """
 
-    def __init__(self, repo_root, hiera_root):
+    def __init__(self, repo_root, hiera_root, module_selector=None):
         """
         Create an object representing the Puppet
         configuration directory.
 
         repo_root should be a full path
         hiera_root should be a full path
+        module_selector is an optional ModuleSelector, only the
+        modules it selects are scanned in each environment
         """
         # Check that the paths exist
         if not os.path.isdir(repo_root):
@@ -130,6 +189,7 @@ class PuppetConfigRepo(object):
         self.starting_dir = os.getcwd()
         self.repo_root = repo_root
         self.hiera_root = hiera_root
+        self.module_selector = module_selector
 
         # See if we are inside a git repo.
         try:
@@ -146,10 +206,49 @@ class PuppetConfigRepo(object):
         """
         return self.environments.keys()
 
-    def migrate(self, from_env, to_env):
+    def hiera_resolver(self, config_path=None):
+        """
+        Returns a HieraResolver for the hiera data of this repository
+        """
+        # Imported here, so that PyYAML is only loaded by hiera lookups
+        from .hiera import HieraResolver
+
+        return HieraResolver(self.hiera_root, config_path)
+
+    def migrate(self, from_env, to_env, hiera_selector=None, progress=None):
         """
-        Migrate data between 2 environments
+        Migrate data between 2 environments, and commit and push
+        the changes if we are in a git repository.
+        See sync for hiera_selector and progress.
         """
+        if progress is None:
+            progress = MigrationProgress()
+
+        touched_paths = self.sync(from_env, to_env, hiera_selector, progress)
+        self.commit_changes(
+            touched_paths,
+            'Migrated changes from %s to %s.'
+            % (from_env, to_env),
+            progress
+        )
+        progress.finish()
+
+    def sync(self, from_env, to_env, hiera_selector=None, progress=None):
+        """
+        Copy the modules and hiera data of from_env over to_env,
+        without committing anything.
+        hiera_selector is an optional ModuleSelector of hiera paths,
+        relative to the environment's hiera directory. Without it the
+        whole hiera directory is migrated, unless the repository was
+        scanned with a module selector, in which case no hiera data is
+        migrated.
+        progress is an optional MigrationProgress the modules
+        and files migrated are counted in.
+        Returns the list of paths changed.
+        """
+        if progress is None:
+            progress = MigrationProgress()
+
         # Check that the environments and hieradata actually exist
         for env in [from_env, to_env]:
             if not env in self.environments:
@@ -206,69 +305,96 @@ class PuppetConfigRepo(object):
             tempcomparison.comparisons[module]['right']
         ]
 
+        # Paths changed by this migration, handed to git afterwards so
+        # only those are staged.
+        touched_paths = []
+
+        progress.start_phase(
+            'sync',
+            len([
+                name for name in left_and_right
+                if tempcomparison.comparisons[name]['comparison'].\
+                get_comparator('fast_forward')
+                or tempcomparison.comparisons[name]['comparison'].\
+                changed_files
+            ]) +
+            len([
+                name for name in left_only
+                if not self.environments[from_env].modules[name].\
+                is_submodule
+            ]) +
+            len([
+                name for name in right_only
+                if not self.environments[to_env].modules[name].\
+                is_submodule
+            ])
+        )
+
         # For each module in the left and right,
-        # that is file based, run rsync
+        # that is file based and differs, run rsync
+        # submodules behind the left are fast forwarded
         for name in left_and_right:
             module = self.environments[from_env].modules[name]
-            if not module.is_submodule:
-                try:
-                    # Rsync directories
-                    rsync = Popen(
-                        [
-                            'rsync',
-                            '-a',
-                            '-v',
-                            '--delete',
-                            '%s/' % module.module_root,
+            comparison = tempcomparison.comparisons[name]['comparison']
+            if comparison.get_comparator('fast_forward'):
+                self.environments[to_env].modules[name].fast_forward(module)
+                touched_paths.append(
+                    self.environments[to_env].modules[name].module_root
+                )
+                progress.module_done()
+            elif not module.is_submodule and comparison.changed_files:
+                # Large files that only differ in places have just the
+                # changed chunks rewritten. Copying the timestamps over
+                # means rsync then sees them as up to date.
+                for path, ranges in comparison.changed_files.items():
+                    if ranges:
+                        source = '%s/%s' % (module.module_root, path)
+                        target = '%s/%s' % (
                             self.environments[to_env].\
-                            modules[name].module_root
-                        ],
-                        stdout=PIPE
-                    )
-                    stdout = rsync.communicate()[0]
-                    if rsync.returncode != 0:
-                        raise PuppetConfigRepoError(
-                            'rsync failed for module %s\n%s'
-                            % (name, stdout)
+                            modules[name].module_root,
+                            path
                         )
-
-                except CalledProcessError:
-                    if rsync.returncode != 0:
-                        raise PuppetConfigRepoError(
-                            'rsync failed for module %s\n%s'
-                            % (name, stdout)
+                        rewrite_ranges(source, target, ranges)
+                        shutil.copystat(source, target)
+                        progress.bytes_transferred(
+                            sum(length for (offset, length) in ranges)
                         )
 
+                # Rsync directories
+                self.run_rsync(
+                    [
+                        '--delete',
+                        '%s/' % module.module_root,
+                        self.environments[to_env].\
+                        modules[name].module_root
+                    ],
+                    'rsync failed for module %s' % name,
+                    progress
+                )
+                touched_paths.append(
+                    self.environments[to_env].modules[name].module_root
+                )
+                progress.module_done()
+
         # For each module only in the left
         # that is file based, run rsync
         for name in left_only:
             module = self.environments[from_env].modules[name]
             if not module.is_submodule:
-                try:
-                    # Rsync directories
-                    rsync = Popen(
-                        [
-                            'rsync',
-                            '-a',
-                            '-v',
-                            '%s' % module.module_root,
-                            '%s/modules' % self.environments[to_env].root_dir
-                        ],
-                        stdout=PIPE
-                    )
-                    stdout = rsync.communicate()[0]
-                    if rsync.returncode != 0:
-                        raise PuppetConfigRepoError(
-                            'rsync failed for module %s\n%s'
-                            % (name, stdout)
-                        )
-
-                except CalledProcessError:
-                    if rsync.returncode != 0:
-                        raise PuppetConfigRepoError(
-                            'rsync failed for module %s\n%s'
-                            % (name, stdout)
-                        )
+                # Rsync directories
+                self.run_rsync(
+                    [
+                        '%s' % module.module_root,
+                        '%s/modules' % self.environments[to_env].root_dir
+                    ],
+                    'rsync failed for module %s' % name,
+                    progress
+                )
+                touched_paths.append(
+                    '%s/modules/%s'
+                    % (self.environments[to_env].root_dir, name)
+                )
+                progress.module_done()
 
         # For each module only in the right
         # that is file based, delete it from the right
@@ -298,46 +424,164 @@ class PuppetConfigRepo(object):
                             'rm failed for module %s\n%s'
                             % (name, stdout)
                         )
+                touched_paths.append(module.module_root)
+                progress.module_done()
 
         # Migrate hiera data
-        try:
+        if hiera_selector:
+            progress.start_phase('hiera')
+            touched_paths += self.migrate_hiera_paths(
+                from_hiera,
+                to_hiera,
+                hiera_selector,
+                progress
+            )
+        elif not self.module_selector:
+            progress.start_phase('hiera')
             # Rsync directories
-            rsync = Popen(
+            self.run_rsync(
                 [
-                    'rsync',
-                    '-a',
-                    '-v',
                     '--delete',
                     '%s/' % from_hiera,
                     to_hiera
                 ],
-                stdout=PIPE
+                'rsync failed for hieradata',
+                progress
             )
-            stdout = rsync.communicate()[0]
-            if rsync.returncode != 0:
-                raise PuppetConfigRepoError(
-                    'rsync failed for hieradata\n%s'
-                    % stdout
-                )
+            touched_paths.append(to_hiera)
 
-        except CalledProcessError:
-            if rsync.returncode != 0:
-                raise PuppetConfigRepoError(
-                    'rsync failed for hieradata\n%s'
-                    % stdout
-                )
+        return touched_paths
 
-        # If we are in a repository, commit the changes.
-        if self.gitrepo:
-            self.gitrepo.add_all()
-            self.gitrepo.commit(
-                'Migrated changes from %s to %s.'
-                % (from_env, to_env)
+    @classmethod
+    def run_rsync(cls, arguments, error_message, progress):
+        """
+        Run rsync -a with the given arguments. Every file transferred
+        is counted in progress as rsync reports it.
+        Raises PuppetConfigRepoError with error_message and the
+        output of rsync if it fails.
+        """
+        # One "size name" line per transferred file
+        rsync = Popen(
+            ['rsync', '-a', '--out-format=%l %n'] + arguments,
+            stdout=PIPE,
+            stderr=STDOUT
+        )
+        output = []
+        for line in rsync.stdout:
+            line = line.decode('utf-8', 'replace')
+            output.append(line)
+            (size, _, name) = line.rstrip('\n').partition(' ')
+            if size.isdigit() and name and not name.endswith('/'):
+                progress.file_transferred(int(size))
+        rsync.wait()
+
+        if rsync.returncode != 0:
+            raise PuppetConfigRepoError(
+                '%s\n%s' % (error_message, ''.join(output))
             )
+
+    def commit_changes(self, touched_paths, commit_message, progress=None):
+        """
+        If we are in a repository, commit and push the changes.
+        Only the paths given are staged, and the branch to
+        push is read from HEAD.
+        """
+        if self.gitrepo:
+            if progress:
+                progress.start_phase('git')
+            self.gitrepo.add_paths(touched_paths)
+            self.gitrepo.commit(commit_message)
             self.gitrepo.push()
 
-        # print(tempcomparison)
-        # print(self.puppetrepo.env_names())
+    @classmethod
+    def select_hiera_paths(cls, hiera_dir, hiera_selector):
+        """
+        Returns the paths below hiera_dir, relative to it, that are
+        selected by hiera_selector. Directories that are selected
+        are not descended into.
+        """
+        selected = []
+        for dirpath, dirnames, filenames in os.walk(hiera_dir):
+            reldir = os.path.relpath(dirpath, hiera_dir)
+            for dirname in list(dirnames):
+                relpath = os.path.normpath(os.path.join(reldir, dirname))
+                if hiera_selector.matches(relpath):
+                    selected.append(relpath)
+                    dirnames.remove(dirname)
+            for filename in filenames:
+                relpath = os.path.normpath(os.path.join(reldir, filename))
+                if hiera_selector.matches(relpath):
+                    selected.append(relpath)
+
+        return selected
+
+    def migrate_hiera_paths(
+            self,
+            from_hiera,
+            to_hiera,
+            hiera_selector,
+            progress
+    ):
+        """
+        Migrate only the selected hiera paths between two hiera
+        directories. Selected paths that only exist in the target
+        are removed. Transfers are counted in progress.
+        Returns the list of paths changed in the target.
+        """
+        from_paths = self.select_hiera_paths(from_hiera, hiera_selector)
+        to_paths = self.select_hiera_paths(to_hiera, hiera_selector)
+        removed_paths = [
+            path for path in to_paths
+            if path not in from_paths
+        ]
+
+        # Copy all the selected paths in a single rsync, the /./
+        # marks where the relative path kept in the target starts
+        if from_paths:
+            self.run_rsync(
+                [
+                    '--delete',
+                    '--relative',
+                ] + [
+                    '%s/./%s' % (from_hiera, path)
+                    for path in from_paths
+                ] + [
+                    '%s/' % to_hiera
+                ],
+                'rsync failed for hieradata',
+                progress
+            )
+
+        if removed_paths:
+            try:
+                rm = Popen(
+                    [
+                        'rm',
+                        '-r',
+                    ] + [
+                        '%s/%s' % (to_hiera, path)
+                        for path in removed_paths
+                    ],
+                    stdout=PIPE
+                )
+                stdout = rm.communicate()[0]
+                if rm.returncode != 0:
+                    raise PuppetConfigRepoError(
+                        'rm failed for hieradata\n%s'
+                        % stdout
+                    )
+
+            except CalledProcessError:
+                if rm.returncode != 0:
+                    raise PuppetConfigRepoError(
+                        'rm failed for hieradata\n%s'
+                        % stdout
+                    )
+
+        return [
+            '%s/%s' % (to_hiera, path)
+            for path in from_paths + removed_paths
+        ]
 
     def find_environments(self):
         """
@@ -357,10 +601,31 @@ class PuppetConfigRepo(object):
 
         environments = dict()
         for env in env_dirs:
-            environments[env] = PuppetEnvironment(env_base_dir + '/' + env)
+            environments[env] = PuppetEnvironment(
+                env_base_dir + '/' + env,
+                self.module_selector
+            )
 
         return environments
 
+    def refresh_environment(self, env):
+        """
+        Rescan a single environment, after it was changed on disk.
+        Returns the new PuppetEnvironment, or None if it is gone.
+        """
+        env_dir = self.repo_root + '/environments/' + env
+        try:
+            self.environments[env] = PuppetEnvironment(
+                env_dir,
+                self.module_selector
+            )
+        except PuppetEnvironmentError:
+            # Removed, or no longer has a modules directory
+            self.environments.pop(env, None)
+            return None
+
+        return self.environments[env]
+
     def __str__(self):
         """
         String representation of a PuppetConfigRepo
@@ -377,13 +642,15 @@ class PuppetEnvironment(object):
     and puppet modules.
     """
 
-    def __init__(self, root_dir):
+    def __init__(self, root_dir, module_selector=None):
         """
         Constructs information about an environment given a full path to
         the root of the directory tree.
         NOTE: root_dir must be an absolute path
         NOTE: git_submodules should be a dict with
         key = directory, value = commit id
+        NOTE: if module_selector is given, only the modules it
+        selects are part of the environment
         """
         if not os.path.isdir(root_dir):
             raise PuppetEnvironmentError('Path is not a directory')
@@ -391,6 +658,7 @@ class PuppetEnvironment(object):
         self.my_submodules = dict()
         self.root_dir = root_dir
         self.envname = os.path.basename(self.root_dir)
+        self.module_selector = module_selector
         self.modules = self.get_puppet_modules()
 
     def get_puppet_modules(self):
@@ -407,8 +675,14 @@ class PuppetEnvironment(object):
         # Get a list of the modules installed
         # This checks to see if they are directories before adding
         # them to the module list.
+        # Unselected modules are dropped by name first, so they are
+        # never stat'ed or looked at by git.
+        module_list = os.listdir(self.root_dir + '/modules')
+        if self.module_selector:
+            module_list = self.module_selector.filter(module_list)
+
         module_list = [
-            f for f in os.listdir(self.root_dir + '/modules')
+            f for f in module_list
             if os.path.isdir(self.root_dir + '/modules/' + f)
         ]
 
@@ -421,6 +695,23 @@ class PuppetEnvironment(object):
 
         return module_dict
 
+    def refresh_module(self, name):
+        """
+        Rescan a single module, after it was changed on disk.
+        Returns the new PuppetModule, or None if it is gone
+        or not selected.
+        """
+        module_root = self.root_dir + '/modules/' + name
+        if (
+                self.module_selector
+                and not self.module_selector.matches(name)
+        ) or not os.path.isdir(module_root):
+            self.modules.pop(name, None)
+            return None
+
+        self.modules[name] = PuppetModule(module_root)
+        return self.modules[name]
+
     def __str__(self):
         """
         String Representation of a PuppetEnvironment
@@ -439,12 +730,18 @@ class PuppetModuleComparison(object):
     Compares 2 module objects
     """
 
+    # Class file hasher, shared so file digests are only worked out once
+    hasher = FileHasher()
+
     def __init__(self, leftmodule, rightmodule):
         """
         Run a comparison of 2 PuppetModule Objects
         """
         self.leftmodule = leftmodule
         self.rightmodule = rightmodule
+        # For plain modules, the relative paths that differ, see
+        # filehash.compare_trees
+        self.changed_files = dict()
         self.comparisons = {
             'exists_in_both': True,
             'exists_in_left': True,
@@ -453,7 +750,8 @@ class PuppetModuleComparison(object):
             'both_submodules': True,
             'both_plain_dirs': True,
             'commits_match': True,
-            'files_match': True
+            'files_match': True,
+            'fast_forward': False
         }
         self.are_equal = True
 
@@ -495,32 +793,26 @@ class PuppetModuleComparison(object):
                     self.are_equal = False
             elif not self.leftmodule.is_submodule:
                 # File based modules, check file contents for equality.
+                self.comparisons['commits_match'] = False
+                self.comparisons['both_submodules'] = False
+                self.comparisons['both_plain_dirs'] = True
                 try:
                     # Compare the two directories
-                    self.comparisons['commits_match'] = False
-                    self.comparisons['both_submodules'] = False
-                    self.comparisons['both_plain_dirs'] = True
-                    commit = Popen(
-                        [
-                            'diff',
-                            '--brief',
-                            '-r',
-                            self.leftmodule.module_root,
-                            self.rightmodule.module_root
-                        ],
-                        stdout=PIPE
+                    self.changed_files = compare_trees(
+                        self.leftmodule.module_root,
+                        self.rightmodule.module_root,
+                        PuppetModuleComparison.hasher
                     )
-                    commit.communicate()
 
-                    if commit.returncode != 0:
-                        self.comparisons['files_match'] = False
-                        self.are_equal = False
-
-                except CalledProcessError:
-                    sys.stderr.write(
-                        "Unable to compare module directories\n"
+                except OSError as error:
+                    raise PuppetModuleError(
+                        'Unable to compare module directories\n%s'
+                        % error
                     )
-                    sys.exit(1)
+
+                if self.changed_files:
+                    self.comparisons['files_match'] = False
+                    self.are_equal = False
 
     def get_comparator(self, comparator):
         """
@@ -590,6 +882,64 @@ class PuppetEnvComparison(object):
             self.comparisons[module]['comparison'] =\
                 PuppetModuleComparison(leftenv, rightenv)
 
+        self.find_fast_forwards()
+
+    def refresh_module(self, module):
+        """
+        Redo the comparison of a single module, after either
+        environment rescanned it
+        """
+        leftmodule = self.leftenv.modules.get(module)
+        rightmodule = self.rightenv.modules.get(module)
+
+        if leftmodule is None and rightmodule is None:
+            self.comparisons.pop(module, None)
+        else:
+            self.comparisons[module] = {
+                'left': leftmodule is not None,
+                'right': rightmodule is not None,
+                'comparison':
+                    PuppetModuleComparison(leftmodule, rightmodule)
+            }
+            self.find_fast_forwards([module])
+
+        # Failure reasons are worked out again by is_migratable
+        self.migration_failure_reasons = dict()
+
+    def find_fast_forwards(self, modules=None):
+        """
+        Mark the submodules whose right commit is an ancestor of the
+        left commit, so the right can be fast forwarded.
+        All the ancestry checks are done in one batch, in the left
+        submodules as those hold the history being migrated.
+        If modules is given only those modules are checked.
+        """
+        if modules is None:
+            modules = self.comparisons
+
+        candidates = [
+            module for module in modules
+            if self.comparisons[module]['left']
+            and self.comparisons[module]['right']
+            and self.comparisons[module]['comparison'].\
+            get_comparator('both_submodules')
+            and not self.comparisons[module]['comparison'].\
+            get_comparator('commits_match')
+        ]
+
+        answers = GitRepo.find_ancestors([
+            (
+                self.leftenv.modules[module].module_root,
+                self.rightenv.modules[module].commit,
+                self.leftenv.modules[module].commit
+            )
+            for module in candidates
+        ])
+
+        for module, is_ancestor in zip(candidates, answers):
+            self.comparisons[module]['comparison'].\
+                comparisons['fast_forward'] = is_ancestor
+
     def is_migratable(self):
         """
         Returns True if a migration would work between the two
@@ -635,13 +985,16 @@ class PuppetEnvComparison(object):
                     self.migration_failure_reasons[module] =\
                         'In both but one is a submodule and one isn\'t'
 
-                # Both are submodules, with different commits
+                # Both are submodules, with different commits that
+                # can't be fast forwarded
                 elif comparison.get_comparator('both_submodules')\
                 and\
-                not comparison.get_comparator('commits_match'):
+                not comparison.get_comparator('commits_match')\
+                and\
+                not comparison.get_comparator('fast_forward'):
                     value = False
                     self.migration_failure_reasons[module] =\
-                        'Both are submodules, but commits don\'t match'
+                        'Both are submodules, but histories have diverged'
 
         return value
 
@@ -0,0 +1,131 @@
+"""
+Tests for staging and committing in GitRepo
+"""
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import subprocess
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from repolibs.gitrepo import GitRepo
+
+# Identity for the commits made in the test repositories
+GIT_ENV = dict(
+    os.environ,
+    GIT_AUTHOR_NAME='test',
+    GIT_AUTHOR_EMAIL='test@example.com',
+    GIT_COMMITTER_NAME='test',
+    GIT_COMMITTER_EMAIL='test@example.com'
+)
+
+def git(repo_dir, *arguments):
+    """
+    Run git in repo_dir, returns its output
+    """
+    return subprocess.run(
+        ['git'] + list(arguments),
+        cwd=repo_dir,
+        env=GIT_ENV,
+        check=True,
+        stdout=subprocess.PIPE
+    ).stdout.decode('utf-8')
+
+def write(path, content):
+    """
+    Write a file, creating its directory
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as output:
+        output.write(content)
+
+class GitRepoTest(unittest.TestCase):
+    """
+    add_paths and commit on a temporary repository
+    """
+
+    def setUp(self):
+        """
+        Create a repository with one committed file
+        """
+        self.cwd = os.getcwd()
+        self.temp_dir = tempfile.mkdtemp()
+        self.repo_dir = self.temp_dir + '/repo'
+        os.mkdir(self.repo_dir)
+        git(self.repo_dir, 'init', '-q')
+        write(self.repo_dir + '/tracked/init.pp', 'class tracked {}\n')
+        git(self.repo_dir, 'add', '-A')
+        git(self.repo_dir, 'commit', '-qm', 'init')
+        # GitRepo commits need an identity too
+        self.environ = mock.patch.dict(os.environ, GIT_ENV)
+        self.environ.start()
+
+    def tearDown(self):
+        """
+        Remove the repository
+        """
+        self.environ.stop()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.temp_dir)
+
+    def staged(self):
+        """
+        Returns the staged paths
+        """
+        return git(self.repo_dir, 'diff', '--cached', '--name-only').split()
+
+    def test_removed_untracked_path(self):
+        """
+        A path that is gone and was never tracked is skipped,
+        instead of failing the whole add
+        """
+        write(self.repo_dir + '/new/init.pp', 'class new {}\n')
+        repo = GitRepo(self.repo_dir)
+        repo.add_paths([self.repo_dir + '/ghost', self.repo_dir + '/new'])
+        self.assertEqual(self.staged(), ['new/init.pp'])
+
+    def test_removed_tracked_path(self):
+        """
+        Removing a tracked directory stages its deletion
+        """
+        shutil.rmtree(self.repo_dir + '/tracked')
+        repo = GitRepo(self.repo_dir)
+        repo.add_paths([self.repo_dir + '/tracked'])
+        self.assertEqual(self.staged(), ['tracked/init.pp'])
+
+    def test_glob_characters_are_literal(self):
+        """
+        Paths are not expanded as globs
+        """
+        write(self.repo_dir + '/w[1]/a', 'a\n')
+        write(self.repo_dir + '/w1/a', 'b\n')
+        repo = GitRepo(self.repo_dir)
+        repo.add_paths([self.repo_dir + '/w[1]'])
+        self.assertEqual(self.staged(), ['w[1]/a'])
+
+    def test_symlinked_root(self):
+        """
+        Paths below a symlink to the repository are staged
+        """
+        link = self.temp_dir + '/link'
+        os.symlink(self.repo_dir, link)
+        write(self.repo_dir + '/new/init.pp', 'class new {}\n')
+        repo = GitRepo(link)
+        self.assertEqual(repo.add_paths([link + '/new']), ['new'])
+        self.assertEqual(self.staged(), ['new/init.pp'])
+
+    def test_commit_with_nothing_staged(self):
+        """
+        Nothing staged is not an error, even with other changes around
+        """
+        write(self.repo_dir + '/tracked/init.pp', 'class changed {}\n')
+        repo = GitRepo(self.repo_dir)
+        head = git(self.repo_dir, 'rev-parse', 'HEAD')
+        repo.commit('nothing')
+        self.assertEqual(git(self.repo_dir, 'rev-parse', 'HEAD'), head)
+
+if __name__ == '__main__':
+    unittest.main()
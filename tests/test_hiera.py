@@ -0,0 +1,265 @@
+"""
+Tests for the batch hiera resolver
+"""
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from repolibs.hiera import HieraResolver, HieraError, yaml
+
+# hiera.yaml version 5, with path and glob levels
+HIERA_V5 = '''
+version: 5
+hierarchy:
+  - name: Per node
+    path: "nodes/%{trusted.certname}.yaml"
+  - name: Per OS
+    path: "os/%{facts.os}.yaml"
+  - name: Extras
+    glob: "extras/*.yaml"
+  - name: Common
+    path: common.yaml
+'''
+
+# hiera.yaml version 3, levels have no extension
+HIERA_V3 = '''
+:backends:
+  - yaml
+:hierarchy:
+  - "nodes/%{::clientcert}"
+  - common
+'''
+
+def write(path, content):
+    """
+    Write a file, creating its directory
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as output:
+        output.write(content)
+
+@unittest.skipIf(yaml is None, 'PyYAML is not installed')
+class HieraResolverTest(unittest.TestCase):
+    """
+    Lookups against a hiera tree in a temporary directory
+    """
+
+    def setUp(self):
+        """
+        Create hiera data for dev and production
+        """
+        self.hiera_root = tempfile.mkdtemp()
+        write(self.hiera_root + '/hiera.yaml', HIERA_V5)
+
+        dev = self.hiera_root + '/environments/dev'
+        write(dev + '/common.yaml', '\n'.join([
+            'ntp::servers: [ntp1, ntp2]',
+            'greeting: "hello %{trusted.certname} in %{environment}"',
+            'users:',
+            '  alice: {shell: bash, groups: {admin: true}}',
+            'level: common',
+            ''
+        ]))
+        write(dev + '/os/debian.yaml', '\n'.join([
+            'ntp::servers: [ntp2, ntp3]',
+            'users:',
+            '  alice: {groups: {dev: true}}',
+            '  bob: {shell: zsh}',
+            'level: os',
+            ''
+        ]))
+        write(dev + '/nodes/web1.yaml', 'level: node\n')
+        write(dev + '/extras/b.yaml', 'extra: b\n')
+        write(dev + '/extras/a.yaml', 'extra: a\n')
+
+        production = self.hiera_root + '/environments/production'
+        write(production + '/common.yaml', '\n'.join([
+            'ntp::servers: [ntp1, ntp2]',
+            'level: production',
+            ''
+        ]))
+
+        self.resolver = HieraResolver(self.hiera_root)
+        self.nodes = {
+            'web1': {'os': 'debian'},
+            'web2': {'os': 'debian'},
+            'db1': {'os': 'redhat'}
+        }
+
+    def tearDown(self):
+        """
+        Remove the hiera data
+        """
+        shutil.rmtree(self.hiera_root)
+
+    def lookup(self, key, merge='first'):
+        """
+        Returns a dict of node to the value of key in dev
+        """
+        values = self.resolver.lookup('dev', [key], self.nodes, merge)
+        return dict((node, values[node].get(key)) for node in values)
+
+    def test_first(self):
+        """
+        The most specific level wins
+        """
+        self.assertEqual(
+            self.lookup('level'),
+            {'web1': 'node', 'web2': 'os', 'db1': 'common'}
+        )
+
+    def test_unique(self):
+        """
+        Arrays are merged, most specific first, without duplicates
+        """
+        self.assertEqual(
+            self.lookup('ntp::servers', 'unique'),
+            {
+                'web1': ['ntp2', 'ntp3', 'ntp1'],
+                'web2': ['ntp2', 'ntp3', 'ntp1'],
+                'db1': ['ntp1', 'ntp2']
+            }
+        )
+
+    def test_hash(self):
+        """
+        Top level keys are merged, nested hashes are replaced
+        """
+        self.assertEqual(
+            self.lookup('users', 'hash')['web1'],
+            {
+                'alice': {'groups': {'dev': True}},
+                'bob': {'shell': 'zsh'}
+            }
+        )
+
+    def test_deep(self):
+        """
+        Nested hashes are merged too
+        """
+        self.assertEqual(
+            self.lookup('users', 'deep')['web1'],
+            {
+                'alice': {
+                    'shell': 'bash',
+                    'groups': {'admin': True, 'dev': True}
+                },
+                'bob': {'shell': 'zsh'}
+            }
+        )
+
+    def test_hash_merge_of_array(self):
+        """
+        Only hashes can be merged as hashes
+        """
+        with self.assertRaises(HieraError):
+            self.lookup('ntp::servers', 'hash')
+
+    def test_glob_level(self):
+        """
+        Files matched by a glob are used in name order
+        """
+        self.assertEqual(self.lookup('extra')['db1'], 'a')
+
+    def test_interpolation_per_node(self):
+        """
+        Nodes sharing data files still get their own interpolations
+        """
+        values = self.resolver.lookup(
+            'dev',
+            ['greeting'],
+            {'web2': {'os': 'debian'}, 'web3': {'os': 'debian'}}
+        )
+        self.assertEqual(values['web2']['greeting'], 'hello web2 in dev')
+        self.assertEqual(values['web3']['greeting'], 'hello web3 in dev')
+
+    def test_all_keys(self):
+        """
+        Without keys every key in the data is looked up
+        """
+        values = self.resolver.lookup('dev', None, {'db1': {'os': 'redhat'}})
+        self.assertEqual(
+            sorted(values['db1']),
+            ['extra', 'greeting', 'level', 'ntp::servers', 'users']
+        )
+
+    def test_nodes_without_facts(self):
+        """
+        A node listed without facts has none
+        """
+        values = self.resolver.lookup('dev', ['level'], {'web1': None})
+        self.assertEqual(values['web1'], {'level': 'node'})
+
+    def test_facts_must_be_a_hash(self):
+        """
+        Facts that are not a hash are refused
+        """
+        with self.assertRaises(HieraError):
+            self.resolver.lookup('dev', ['level'], {'web1': ['debian']})
+
+    def test_diff(self):
+        """
+        Only the keys that differ between environments are returned
+        """
+        differences = self.resolver.diff(
+            'dev',
+            'production',
+            ['level', 'ntp::servers', 'extra'],
+            {'db1': {'os': 'redhat'}}
+        )
+        self.assertEqual(
+            differences,
+            {'db1': {
+                'level': ('common', 'production'),
+                'extra': ('a', None)
+            }}
+        )
+
+    def test_unknown_environment(self):
+        """
+        An environment without hiera data is an error
+        """
+        with self.assertRaises(HieraError):
+            self.resolver.lookup('staging', ['level'], self.nodes)
+
+@unittest.skipIf(yaml is None, 'PyYAML is not installed')
+class HieraV3Test(unittest.TestCase):
+    """
+    Lookups with a version 3 hierarchy
+    """
+
+    def setUp(self):
+        """
+        Create hiera data with YAML and JSON files
+        """
+        self.hiera_root = tempfile.mkdtemp()
+        write(self.hiera_root + '/hiera.yaml', HIERA_V3)
+        dev = self.hiera_root + '/environments/dev'
+        write(dev + '/common.yaml', 'level: common\nname: "%{::clientcert}"\n')
+        write(dev + '/nodes/web1.json', json.dumps({'level': 'node'}))
+
+    def tearDown(self):
+        """
+        Remove the hiera data
+        """
+        shutil.rmtree(self.hiera_root)
+
+    def test_levels_without_extension(self):
+        """
+        Levels find their data file with any known extension
+        """
+        values = HieraResolver(self.hiera_root).lookup(
+            'dev',
+            ['level', 'name'],
+            {'web1': {}, 'web2': {}}
+        )
+        self.assertEqual(values['web1'], {'level': 'node', 'name': 'web1'})
+        self.assertEqual(values['web2'], {'level': 'common', 'name': 'web2'})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+"""
+Tests for the migration queue
+"""
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from repolibs.jobqueue import MigrationQueue, MigrationQueueError
+
+class MigrationQueueTest(unittest.TestCase):
+    """
+    Queue bookkeeping, without running any migrations
+    """
+
+    def setUp(self):
+        """
+        Create an empty queue
+        """
+        self.queue_dir = tempfile.mkdtemp()
+        self.queue = MigrationQueue(self.queue_dir, '/nonexistent', '/nonexistent')
+
+    def tearDown(self):
+        """
+        Remove the queue
+        """
+        shutil.rmtree(self.queue_dir)
+
+    def test_refuses_same_environment(self):
+        """
+        A migration into its own source would never be claimed
+        """
+        with self.assertRaises(MigrationQueueError):
+            self.queue.submit('dev', 'dev')
+        self.assertEqual(self.queue.queued_jobs(), [])
+
+    def test_orphaned_job_is_dropped(self):
+        """
+        A queued job left by a dead process no longer blocks
+        migrations into its source
+        """
+        with open(self.queue.job_path('00000000000000000001-1'), 'w') as job:
+            json.dump({
+                'from_env': 'production',
+                'to_env': 'staging',
+                'job_id': '00000000000000000001-1',
+                'status': 'queued'
+            }, job)
+
+        job = self.queue.submit('dev', 'production')
+        locks = self.queue.lock_environments('dev', 'production')
+        try:
+            batch = self.queue.claim_batch('production', locks)
+        finally:
+            for lock in locks.values():
+                lock.close()
+
+        self.assertEqual([queued.job_id for queued in batch], [job.job_id])
+        self.assertFalse(
+            os.path.exists(self.queue.job_path('00000000000000000001-1'))
+        )
+
+    def test_live_job_is_kept(self):
+        """
+        A queued job whose submitter is still waiting is not dropped
+        """
+        other = MigrationQueue(self.queue_dir, '/nonexistent', '/nonexistent')
+        waiting = other.submit('production', 'staging')
+        job = self.queue.submit('dev', 'production')
+
+        locks = self.queue.lock_environments('dev', 'production')
+        try:
+            batch = self.queue.claim_batch('production', locks)
+        finally:
+            for lock in locks.values():
+                lock.close()
+
+        # The waiting job reads from production, so it has to go first
+        self.assertEqual(batch, [])
+        self.assertEqual(
+            [queued.job_id for queued in self.queue.queued_jobs()],
+            [waiting.job_id, job.job_id]
+        )
+
+if __name__ == '__main__':
+    unittest.main()
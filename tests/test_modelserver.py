@@ -0,0 +1,216 @@
+"""
+Tests for the model server, on a temporary puppet repository
+"""
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import unittest
+import subprocess
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from repolibs.inotify import Inotify
+from repolibs.modelclient import ModelClient
+from repolibs.modelserver import ModelServer
+from repolibs.moduleselector import ModuleSelector
+from repolibs.puppetrepo import PuppetConfigRepo, PuppetModuleError
+
+# Identity for the commits made in the test repository
+GIT_ENV = dict(
+    os.environ,
+    GIT_AUTHOR_NAME='test',
+    GIT_AUTHOR_EMAIL='test@example.com',
+    GIT_COMMITTER_NAME='test',
+    GIT_COMMITTER_EMAIL='test@example.com'
+)
+
+def git(repo_dir, *arguments):
+    """
+    Run git in repo_dir
+    """
+    subprocess.run(
+        ['git'] + list(arguments),
+        cwd=repo_dir,
+        env=GIT_ENV,
+        check=True,
+        stdout=subprocess.DEVNULL
+    )
+
+def write(path, content):
+    """
+    Write a file, creating its directory
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as output:
+        output.write(content)
+
+class ModelServerTest(unittest.TestCase):
+    """
+    Incremental updates and queries
+    """
+
+    def setUp(self):
+        """
+        Create a repository with dev and production environments,
+        each with the plain modules apache and nginx
+        """
+        self.cwd = os.getcwd()
+        self.repo_dir = tempfile.mkdtemp()
+        for env in ['dev', 'production']:
+            for module in ['apache', 'nginx']:
+                write(
+                    '%s/environments/%s/modules/%s/manifests/init.pp'
+                    % (self.repo_dir, env, module),
+                    'class %s {}\n' % module
+                )
+            write(
+                '%s/hiera/environments/%s/common.yaml' % (self.repo_dir, env),
+                'key: %s\n' % env
+            )
+        git(self.repo_dir, 'init', '-q')
+        git(self.repo_dir, 'add', '-A')
+        git(self.repo_dir, 'commit', '-qm', 'init')
+        self.server = None
+
+    def tearDown(self):
+        """
+        Stop the server and remove the repository
+        """
+        if self.server is not None:
+            self.server.close()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.repo_dir)
+
+    def make_server(self, module_selector=None):
+        """
+        Create a server for the repository
+        """
+        self.server = ModelServer(
+            PuppetConfigRepo(
+                self.repo_dir,
+                self.repo_dir + '/hiera',
+                module_selector
+            ),
+            self.repo_dir + '/.git/cultivate.sock'
+        )
+        return self.server
+
+    def start(self):
+        """
+        Set up a server with its watches, without serving
+        """
+        self.make_server()
+        self.server.inotify = Inotify()
+        self.server.watch_all()
+        return self.server
+
+    def module_comparisons(self):
+        """
+        Returns the cached PuppetModuleComparisons of dev to production
+        """
+        comparison = self.server.comparisons[('dev', 'production')]
+        return dict(
+            (module, values['comparison'])
+            for module, values in comparison.comparisons.items()
+        )
+
+    def test_module_change_only_rebuilds_that_module(self):
+        """
+        Editing one module redoes its comparison and keeps the others
+        """
+        server = self.start()
+        server.comparison('dev', 'production')
+        before = self.module_comparisons()
+        self.assertTrue(before['apache'].are_equal)
+
+        write(
+            self.repo_dir + '/environments/dev/modules/apache/manifests/init.pp',
+            'class apache { notify { "changed": } }\n'
+        )
+        server.process_events()
+
+        after = self.module_comparisons()
+        self.assertIsNot(after['apache'], before['apache'])
+        self.assertFalse(after['apache'].are_equal)
+        self.assertIs(after['nginx'], before['nginx'])
+        self.assertIn(('dev', 'production'), server.comparisons)
+
+    def test_head_change_reloads(self):
+        """
+        A new HEAD in the top level repository rebuilds everything
+        """
+        server = self.start()
+        server.comparison('dev', 'production')
+        environments = server.puppetrepo.environments
+        generation = server.generations['hiera']
+
+        git(self.repo_dir, 'checkout', '-q', '-b', 'other')
+        server.process_events()
+
+        self.assertEqual(server.comparisons, dict())
+        self.assertIsNot(server.puppetrepo.environments, environments)
+        self.assertEqual(server.generations['hiera'], generation + 1)
+
+    def test_failed_rescan_is_retried(self):
+        """
+        A module that can't be rescanned drops its comparisons, and is
+        rescanned with the next request instead of stopping the server
+        """
+        server = self.start()
+        server.comparison('dev', 'production')
+        env = server.puppetrepo.environments['dev']
+
+        write(
+            self.repo_dir + '/environments/dev/modules/nginx/files/vanished',
+            'x\n'
+        )
+        with mock.patch.object(
+                env,
+                'refresh_module',
+                side_effect=PuppetModuleError('No such file or directory')
+        ):
+            server.process_events()
+
+        self.assertIn(('module', 'dev', 'nginx'), server.failed_changes)
+        self.assertNotIn(('dev', 'production'), server.comparisons)
+
+        output = server.handle({
+            'command': 'compare',
+            'from_env': 'dev',
+            'to_env': 'production'
+        })
+        self.assertEqual(server.failed_changes, set())
+        self.assertIn('Module name: nginx', output)
+
+    def test_other_selection_is_ignored(self):
+        """
+        Answers from a server holding other modules are not used
+        """
+        server = self.make_server(ModuleSelector('apache'))
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+
+        client = ModelClient(server.socket_path)
+        try:
+            # Wait until the server answers
+            for _ in range(100):
+                if client.is_available()\
+                and client.query('status', 'apache') is not None:
+                    break
+                thread.join(0.05)
+
+            self.assertIsNone(client.query('report'))
+            self.assertIsNone(client.query('report', 'nginx'))
+            output = client.query('report', 'apache')
+            self.assertIn('Module Name: apache', output)
+            self.assertNotIn('Module Name: nginx', output)
+        finally:
+            client.query('shutdown', 'apache')
+            thread.join(5)
+            self.server = None
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+"""
+Tests for module selectors
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from repolibs.moduleselector import ModuleSelector, ModuleSelectorError
+
+class ModuleSelectorTest(unittest.TestCase):
+    """
+    Parsing and matching of selectors
+    """
+
+    def test_globs_match_whole_names(self):
+        """
+        Globs are anchored at both ends
+        """
+        selector = ModuleSelector('profile_*, nginx')
+        self.assertEqual(
+            selector.filter(['profile_web', 'nginx', 'nginx_ext', 'apache']),
+            ['profile_web', 'nginx']
+        )
+
+    def test_commas_inside_regular_expressions(self):
+        """
+        A quantifier with a comma stays one selector
+        """
+        selector = ModuleSelector('re:^a{1,2}$,nginx')
+        self.assertEqual(selector.selectors, ['re:^a{1,2}$', 'nginx'])
+        self.assertEqual(
+            selector.filter(['a', 'aa', 'aaa', 'nginx', '2}$']),
+            ['a', 'aa', 'nginx']
+        )
+        # The string form reads back the same
+        self.assertEqual(
+            ModuleSelector(str(selector)).selectors,
+            selector.selectors
+        )
+
+    def test_inline_flags(self):
+        """
+        Inline flags only have to be at the start of their own selector
+        """
+        selector = ModuleSelector('apache,re:(?i)nginx')
+        self.assertEqual(
+            selector.filter(['apache', 'NGINX', 'Apache']),
+            ['apache', 'NGINX']
+        )
+
+    def test_invalid_regular_expression(self):
+        """
+        Broken regular expressions are a ModuleSelectorError
+        """
+        with self.assertRaises(ModuleSelectorError):
+            ModuleSelector('re:(nginx')
+
+    def test_empty_selector(self):
+        """
+        Only separators is an error
+        """
+        with self.assertRaises(ModuleSelectorError):
+            ModuleSelector(' , ')
+
+if __name__ == '__main__':
+    unittest.main()
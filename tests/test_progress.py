@@ -0,0 +1,79 @@
+"""
+Tests for migration progress reporting
+"""
+import io
+import os
+import sys
+import json
+import time
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from repolibs.progress import MigrationProgress
+
+class MigrationProgressTest(unittest.TestCase):
+    """
+    Counting and periodic output
+    """
+
+    def test_stall_is_reported(self):
+        """
+        Metrics keep coming while nothing is transferred, with
+        seconds_since_progress growing
+        """
+        metrics = io.StringIO()
+        progress = MigrationProgress(
+            metrics_stream=metrics,
+            metrics_interval=0.2
+        )
+        progress.start_phase('sync', 1)
+        time.sleep(0.9)
+        progress.stop()
+
+        lines = [json.loads(line) for line in metrics.getvalue().splitlines()]
+        self.assertGreaterEqual(len(lines), 3)
+        stalls = [line['seconds_since_progress'] for line in lines]
+        self.assertEqual(stalls, sorted(stalls))
+        self.assertGreater(stalls[-1], 0.5)
+
+    def test_counts_and_textfile(self):
+        """
+        The textfile holds the counts, with the labels
+        """
+        with tempfile.TemporaryDirectory() as temp_dir:
+            textfile = temp_dir + '/cultivate.prom'
+            progress = MigrationProgress(
+                textfile=textfile,
+                labels={'from_env': 'dev', 'to_env': 'production'}
+            )
+            progress.start_phase('sync', 2)
+            progress.file_transferred(100)
+            progress.bytes_transferred(50)
+            progress.module_done()
+            progress.finish()
+
+            with open(textfile) as metrics:
+                content = metrics.read()
+
+        labels = 'from_env="dev",to_env="production"'
+        for line in [
+                'cultivate_migration_modules_done{%s} 1' % labels,
+                'cultivate_migration_modules_total{%s} 2' % labels,
+                'cultivate_migration_files_transferred_total{%s} 1' % labels,
+                'cultivate_migration_bytes_transferred_total{%s} 150' % labels,
+                'cultivate_migration_phase{%s,phase="done"} 1' % labels,
+        ]:
+            self.assertIn(line, content.splitlines())
+
+    def test_no_outputs_no_timer(self):
+        """
+        A progress that only counts starts no thread
+        """
+        progress = MigrationProgress()
+        self.assertIsNone(progress.timer)
+        progress.finish()
+
+if __name__ == '__main__':
+    unittest.main()